@@ -0,0 +1,196 @@
+import heapq
+
+from sqlmodel import Session
+
+from ..models.company import Company
+from ..models.companywastelink import CompanyWasteLink
+from ..models.route import RouteAlternativePublic, WasteCoverage
+from .road_graph import RoadGraph, get_road_graph
+from .capacity_index import CapacityIndex, load_capacity_index
+from .optimal_route import SearchStats, load_storages
+
+
+# Virtual node, that every target storage leads to
+SINK = -1
+
+# (nodes from company to the last storage, distances along the route)
+Path = tuple[tuple[int, ...], tuple[int, ...]]
+
+
+def find_alternative_unload_routes(
+        session: Session, company: Company,
+        company_waste_links: list[CompanyWasteLink], k: int,
+        capacity_index: CapacityIndex | None = None,
+        graph: RoadGraph | None = None, stats: SearchStats | None = None
+        ) -> list[RouteAlternativePublic]:
+    """ Find k shortest loopless routes to storages, that can recieve all
+    waste types (Yen's algorithm)
+
+    Distances to the nearest target storage are computed once with
+    a reverse search. They are exact lower bounds for every spur search
+    (removed roads only make routes longer), so spur searches (A*) expand
+    few locations besides the found route
+    """
+    if graph is None:
+        graph = get_road_graph(session=session)
+    source = graph.company_nodes[company.id]
+    waste_ids = [waste_link.waste_id for waste_link in company_waste_links]
+    waste_amounts = [waste_link.amount for waste_link in company_waste_links]
+    if capacity_index is None:
+        capacity_index = load_capacity_index(
+            session=session, waste_ids=waste_ids)
+    targets = {
+        storage_node
+        for storage_id, storage_node in graph.storage_nodes.items()
+        if all(capacity_index.get((storage_id, waste_id), 0) >= waste_amount
+               for waste_id, waste_amount in zip(waste_ids, waste_amounts))
+        }
+    target_distances = find_target_distances(graph=graph, targets=targets)
+
+    path = find_spur_path(
+        graph=graph, spur_node=source, targets=targets,
+        target_distances=target_distances, blocked_nodes=set(),
+        removed_roads=set(), stats=stats
+        )
+    if path is None:
+        return []
+    paths = [path]
+    candidates = []
+    known_routes = {path[0]}
+    while len(paths) < k:
+        last_nodes, last_distances = paths[-1]
+        for i, spur_node in enumerate(last_nodes):
+            root_nodes = last_nodes[:i + 1]
+            # Roads, that lead from the spur node along found routes with
+            # the same root (SINK for routes, that end in the spur node)
+            removed_roads = set()
+            for nodes, _ in paths:
+                if nodes[:i + 1] == root_nodes:
+                    next_node = nodes[i + 1] if i + 1 < len(nodes) else SINK
+                    removed_roads.add((spur_node, next_node))
+            spur_path = find_spur_path(
+                graph=graph, spur_node=spur_node, targets=targets,
+                target_distances=target_distances,
+                blocked_nodes=set(root_nodes[:-1]),
+                removed_roads=removed_roads, stats=stats
+                )
+            if spur_path is None:
+                continue
+            spur_nodes, spur_distances = spur_path
+            nodes = root_nodes + spur_nodes[1:]
+            if nodes in known_routes:
+                continue
+            known_routes.add(nodes)
+            distances = last_distances[:i + 1] + tuple(
+                last_distances[i] + distance
+                for distance in spur_distances[1:]
+                )
+            heapq.heappush(candidates, (distances[-1], nodes, distances))
+        if not candidates:
+            break
+        _, nodes, distances = heapq.heappop(candidates)
+        paths.append((nodes, distances))
+
+    storage_ids = {
+        graph.storage_ids[node] for nodes, _ in paths for node in nodes[1:]}
+    storages = load_storages(session=session, storage_ids=list(storage_ids))
+    routes = []
+    for nodes, distances in paths:
+        last_storage_id = graph.storage_ids[nodes[-1]]
+        coverage = [
+            WasteCoverage(
+                waste_id=waste_id, amount=waste_amount,
+                free_amount=capacity_index.get(
+                    (last_storage_id, waste_id), 0)
+                )
+            for waste_id, waste_amount in zip(waste_ids, waste_amounts)
+            ]
+        routes.append(RouteAlternativePublic(
+            route_history=[
+                storages[graph.storage_ids[node]] for node in nodes[1:]],
+            distance=distances[-1], coverage=coverage
+            ))
+    return routes
+
+
+def find_target_distances(
+        graph: RoadGraph, targets: set[int]) -> dict[int, int]:
+    """ Shortest distance from every location to the nearest target
+    (reverse search from all targets at once)
+    """
+    offsets, sources, road_distances = graph.reverse_roads()
+    distances = {}
+    location_queue = [(0, target) for target in targets]
+    heapq.heapify(location_queue)
+    while location_queue:
+        distance, location = heapq.heappop(location_queue)
+        if location in distances:
+            continue
+        distances[location] = distance
+        for position in range(offsets[location], offsets[location + 1]):
+            previous_location = sources[position]
+            if previous_location not in distances:
+                heapq.heappush(
+                    location_queue,
+                    (distance + road_distances[position], previous_location)
+                    )
+    return distances
+
+
+def find_spur_path(
+        graph: RoadGraph, spur_node: int, targets: set[int],
+        target_distances: dict[int, int], blocked_nodes: set[int],
+        removed_roads: set[tuple[int, int]], stats: SearchStats | None
+        ) -> Path | None:
+    """ Shortest route from spur node to any target (A* with distances to
+    targets as potentials), avoiding blocked nodes and removed roads
+    """
+    if spur_node not in target_distances:
+        return None
+    best_distances = {spur_node: 0}
+    parents = {spur_node: None}
+    visited_locations = set()
+    location_queue = [(target_distances[spur_node], 0, spur_node)]
+    while location_queue:
+        _, distance, location = heapq.heappop(location_queue)
+        if location == SINK:
+            break
+        if location in visited_locations:
+            continue
+        visited_locations.add(location)
+        if stats is not None:
+            stats.expansions += 1
+        if location in targets and (location, SINK) not in removed_roads:
+            if distance < best_distances.get(SINK, distance + 1):
+                best_distances[SINK] = distance
+                parents[SINK] = location
+                heapq.heappush(location_queue, (distance, distance, SINK))
+        for next_location, road_distance in graph.roads_from(location):
+            if (next_location in blocked_nodes
+                    or next_location in visited_locations
+                    or (location, next_location) in removed_roads):
+                continue
+            target_distance = target_distances.get(next_location)
+            # No target can be reached from the location
+            if target_distance is None:
+                continue
+            next_distance = distance + road_distance
+            if next_distance < best_distances.get(
+                    next_location, next_distance + 1):
+                best_distances[next_location] = next_distance
+                parents[next_location] = location
+                heapq.heappush(
+                    location_queue,
+                    (next_distance + target_distance, next_distance,
+                     next_location)
+                    )
+    else:
+        return None
+    nodes = []
+    location = parents[SINK]
+    while location is not None:
+        nodes.append(location)
+        location = parents[location]
+    nodes.reverse()
+    return (tuple(nodes),
+            tuple(best_distances[location] for location in nodes))
@@ -0,0 +1,51 @@
+import time
+
+from sqlalchemy import Engine
+from sqlmodel import Session, select
+
+from ..models.cacheversion import CacheVersion
+from .. import crud
+
+
+# Id of the single row of versions
+CACHE_VERSION_ID = 1
+
+
+def get_cache_version(session: Session, field: str) -> int | None:
+    """ Current version from the database (None if the versions row is not
+    created yet, then data must not be cached)
+    """
+    return session.exec(
+        select(getattr(CacheVersion, field))
+        .where(CacheVersion.id == CACHE_VERSION_ID)
+        ).first()
+
+
+def bump_cache_version(session: Session, field: str):
+    """ Increment version in its own transaction, must be called after the
+    change is committed
+    """
+    version = crud.increment_db_field(
+        session=session, db_table=CacheVersion,
+        filters={"id": CACHE_VERSION_ID}, field=field, delta=1
+        )
+    if version is None:
+        session.add(create_cache_version_row())
+    session.commit()
+
+
+def create_cache_version(engine: Engine):
+    with Session(engine) as session:
+        if session.get(CacheVersion, CACHE_VERSION_ID) is None:
+            session.add(create_cache_version_row())
+            session.commit()
+
+
+def create_cache_version_row() -> CacheVersion:
+    # Versions start from the creation time (microseconds), so versions of
+    # a recreated database differ from versions cached before
+    start_version = time.time_ns() // 1000
+    return CacheVersion(
+        id=CACHE_VERSION_ID, graph_version=start_version,
+        capacity_version=start_version
+        )
@@ -0,0 +1,37 @@
+from sqlmodel import Session, select
+
+from ..models.storagewastelink import StorageWasteLink
+from .cache_version import get_cache_version, bump_cache_version
+
+
+# (storage id, waste id) -> free space (max_amount - amount)
+CapacityIndex = dict[tuple[int, int], int]
+
+
+def get_capacity_version(session: Session) -> int | None:
+    return get_cache_version(session=session, field="capacity_version")
+
+
+def bump_capacity_version(session: Session):
+    """ Must be called whenever amount or max amount of a storage waste
+    link changes
+    """
+    bump_cache_version(session=session, field="capacity_version")
+
+
+def load_capacity_index(
+        session: Session, waste_ids: list[int] | None = None
+        ) -> CapacityIndex:
+    """ Load free space of storages with one bulk query, optionally only
+    for specified waste types
+    """
+    statement = select(
+        StorageWasteLink.storage_id, StorageWasteLink.waste_id,
+        StorageWasteLink.max_amount - StorageWasteLink.amount
+        )
+    if waste_ids is not None:
+        statement = statement.where(StorageWasteLink.waste_id.in_(waste_ids))
+    return {
+        (storage_id, waste_id): free_space
+        for storage_id, waste_id, free_space in session.exec(statement)
+        }
@@ -0,0 +1,301 @@
+import heapq
+import logging
+from array import array
+from collections.abc import Callable
+from threading import Lock, Thread
+
+from .road_graph import RoadGraph, is_outdated_road_graph
+
+
+logger = logging.getLogger(__name__)
+
+# Max number of locations settled by a witness search
+WITNESS_SEARCH_LIMIT = 500
+# Number of contracted locations between checks, that build is outdated
+CANCEL_CHECK_INTERVAL = 256
+
+# (snapshot, thread) of the last started build, one build runs at a time
+current_build: tuple[RoadGraph, Thread] | None = None
+current_build_lock = Lock()
+
+
+class ContractionHierarchy:
+    """ Road network with locations ordered by importance (rank) and
+    shortcut roads, that replace routes through less important locations
+
+    Shortcuts are added only for routes through contracted storages, so
+    routes still pass only through storages (companies have no roads
+    leading to them and are contracted first without shortcuts). Distance
+    query is a bidirectional search, that only goes up in rank
+    """
+
+    def __init__(
+            self, up_offsets: array, up_targets: array, up_distances: array,
+            down_offsets: array, down_sources: array, down_distances: array
+            ):
+        # Roads from node to more important nodes (CSR)
+        self.up_offsets = up_offsets
+        self.up_targets = up_targets
+        self.up_distances = up_distances
+        # Roads to node from more important nodes (reverse CSR)
+        self.down_offsets = down_offsets
+        self.down_sources = down_sources
+        self.down_distances = down_distances
+
+    def find_distance(self, source: int, target: int) -> int | None:
+        """ Shortest distance from source to target (None if unreachable) """
+        searches = (
+            (self.up_offsets, self.up_targets, self.up_distances),
+            (self.down_offsets, self.down_sources, self.down_distances)
+            )
+        distances = ({source: 0}, {target: 0})
+        location_queues = ([(0, source)], [(0, target)])
+        best_distance = None
+        side = 0
+        while location_queues[0] or location_queues[1]:
+            # Alternate directions, skip finished ones
+            if not location_queues[side]:
+                side = 1 - side
+            distance, location = heapq.heappop(location_queues[side])
+            if best_distance is not None and distance >= best_distance:
+                # Nothing shorter can be found in this direction
+                location_queues[side].clear()
+                side = 1 - side
+                continue
+            if distance > distances[side][location]:
+                side = 1 - side
+                continue
+            other_distance = distances[1 - side].get(location)
+            if other_distance is not None and (
+                    best_distance is None
+                    or distance + other_distance < best_distance):
+                best_distance = distance + other_distance
+            offsets, targets, road_distances = searches[side]
+            for position in range(offsets[location], offsets[location + 1]):
+                next_location = targets[position]
+                next_distance = distance + road_distances[position]
+                if next_distance < distances[side].get(
+                        next_location, next_distance + 1):
+                    distances[side][next_location] = next_distance
+                    heapq.heappush(
+                        location_queues[side], (next_distance, next_location))
+            side = 1 - side
+        return best_distance
+
+
+def get_contraction_hierarchy(
+        graph: RoadGraph, wait: bool = False
+        ) -> ContractionHierarchy | None:
+    """ Contraction hierarchy of the road network snapshot. It is built in
+    a background thread on first use, None is returned until it is ready
+    (unless "wait" is set). Only one build runs at a time: build for
+    a newer snapshot replaces the current one, builds for outdated
+    snapshots are not started
+    """
+    global current_build
+    with graph.indexes_lock:
+        contraction_hierarchy = graph.indexes.get("contraction_hierarchy")
+        if contraction_hierarchy is not None:
+            return contraction_hierarchy
+    with current_build_lock:
+        if current_build is not None and current_build[0] is graph:
+            build_thread = current_build[1]
+        elif current_build is not None and current_build[1].is_alive() \
+                and is_older_road_graph(
+                    graph=graph, other_graph=current_build[0]):
+            # Snapshot is outdated, build for a newer one is running
+            return None
+        else:
+            build_thread = Thread(
+                target=store_contraction_hierarchy, kwargs={"graph": graph},
+                daemon=True
+                )
+            current_build = (graph, build_thread)
+            build_thread.start()
+    if wait:
+        build_thread.join()
+        return graph.indexes.get("contraction_hierarchy")
+    return None
+
+
+def is_older_road_graph(graph: RoadGraph, other_graph: RoadGraph) -> bool:
+    # Snapshot without version is never cached, so it is treated as older
+    return (graph.version is None or other_graph.version is not None
+            and graph.version < other_graph.version)
+
+
+def is_outdated_build(graph: RoadGraph) -> bool:
+    """ Check if build for the snapshot was replaced or a newer snapshot
+    was loaded
+    """
+    with current_build_lock:
+        if current_build is None or current_build[0] is not graph:
+            return True
+    return is_outdated_road_graph(graph=graph)
+
+
+def store_contraction_hierarchy(graph: RoadGraph):
+    global current_build
+    try:
+        contraction_hierarchy = build_contraction_hierarchy(
+            graph=graph, is_cancelled=lambda: is_outdated_build(graph=graph))
+    except Exception:
+        logger.exception("Contraction hierarchy build failed")
+        # Next request starts the build again
+        with current_build_lock:
+            if current_build is not None and current_build[0] is graph:
+                current_build = None
+        return
+    if contraction_hierarchy is None:
+        logger.info("Contraction hierarchy build for outdated road network "
+                    "is cancelled")
+        return
+    with graph.indexes_lock:
+        graph.indexes["contraction_hierarchy"] = contraction_hierarchy
+
+
+def build_contraction_hierarchy(
+        graph: RoadGraph, is_cancelled: Callable[[], bool] | None = None
+        ) -> ContractionHierarchy | None:
+    """ Contract locations one by one, least important first. Importance
+    is edge difference (shortcuts added minus roads removed) plus number
+    of contracted neighbours, updated lazily. Build is stopped (None is
+    returned), when "is_cancelled" returns True, it is checked every
+    CANCEL_CHECK_INTERVAL contractions
+    """
+    node_count = len(graph)
+    roads_from = [{} for _ in range(node_count)]
+    roads_to = [{} for _ in range(node_count)]
+    for node_from in range(node_count):
+        for node_to, distance in graph.roads_from(node_from):
+            if distance < roads_from[node_from].get(node_to, distance + 1):
+                roads_from[node_from][node_to] = distance
+                roads_to[node_to][node_from] = distance
+
+    contracted_neighbours = array("q", bytes(8 * node_count))
+    node_queue = [
+        (get_priority(
+            node=node, roads_from=roads_from, roads_to=roads_to,
+            contracted_neighbours=contracted_neighbours), node)
+        for node in range(node_count)
+        ]
+    heapq.heapify(node_queue)
+    ranks = array("q", [-1]) * node_count
+    rank = 0
+    # Initial priorities take a noticeable part of the build
+    if is_cancelled is not None and is_cancelled():
+        return None
+    while node_queue:
+        _, node = heapq.heappop(node_queue)
+        priority = get_priority(
+            node=node, roads_from=roads_from, roads_to=roads_to,
+            contracted_neighbours=contracted_neighbours)
+        # Lazy update: contract later, if node became more important
+        if node_queue and priority > node_queue[0][0]:
+            heapq.heappush(node_queue, (priority, node))
+            continue
+        for node_from, node_to, distance in find_shortcuts(
+                node=node, roads_from=roads_from, roads_to=roads_to):
+            roads_from[node_from][node_to] = distance
+            roads_to[node_to][node_from] = distance
+        # Keep roads of the contracted node, remove them from neighbours
+        for node_to in roads_from[node]:
+            del roads_to[node_to][node]
+            contracted_neighbours[node_to] += 1
+        for node_from in roads_to[node]:
+            del roads_from[node_from][node]
+            contracted_neighbours[node_from] += 1
+        ranks[node] = rank
+        rank += 1
+        if rank % CANCEL_CHECK_INTERVAL == 0 and is_cancelled is not None \
+                and is_cancelled():
+            return None
+
+    # Remaining roads of every node lead to more important nodes
+    up_offsets, up_targets, up_distances = build_csr(
+        node_count=node_count, node_roads=roads_from)
+    down_offsets, down_sources, down_distances = build_csr(
+        node_count=node_count, node_roads=roads_to)
+    return ContractionHierarchy(
+        up_offsets=up_offsets, up_targets=up_targets,
+        up_distances=up_distances, down_offsets=down_offsets,
+        down_sources=down_sources, down_distances=down_distances
+        )
+
+
+def get_priority(
+        node: int, roads_from: list[dict[int, int]],
+        roads_to: list[dict[int, int]], contracted_neighbours: array
+        ) -> int:
+    shortcuts = find_shortcuts(
+        node=node, roads_from=roads_from, roads_to=roads_to)
+    return (len(shortcuts) - len(roads_from[node]) - len(roads_to[node])
+            + contracted_neighbours[node])
+
+
+def find_shortcuts(
+        node: int, roads_from: list[dict[int, int]],
+        roads_to: list[dict[int, int]]
+        ) -> list[tuple[int, int, int]]:
+    """ Shortcuts needed to contract node: for every pair of neighbours,
+    that has no other route as short as the route through node (witness)
+    """
+    shortcuts = []
+    if not roads_from[node]:
+        return shortcuts
+    max_road_distance = max(roads_from[node].values())
+    for node_from, distance_to_node in roads_to[node].items():
+        witness_distances = find_witness_distances(
+            source=node_from, skipped_node=node, roads_from=roads_from,
+            max_distance=distance_to_node + max_road_distance
+            )
+        for node_to, distance_from_node in roads_from[node].items():
+            if node_to == node_from:
+                continue
+            distance = distance_to_node + distance_from_node
+            witness_distance = witness_distances.get(node_to)
+            if witness_distance is None or witness_distance > distance:
+                shortcuts.append((node_from, node_to, distance))
+    return shortcuts
+
+
+def find_witness_distances(
+        source: int, skipped_node: int, roads_from: list[dict[int, int]],
+        max_distance: int
+        ) -> dict[int, int]:
+    """ Limited search from source, that does not pass through skipped
+    node. Missed witnesses only add unnecessary shortcuts
+    """
+    distances = {source: 0}
+    location_queue = [(0, source)]
+    settled = 0
+    while location_queue and settled < WITNESS_SEARCH_LIMIT:
+        distance, location = heapq.heappop(location_queue)
+        if distance > distances[location]:
+            continue
+        if distance > max_distance:
+            break
+        settled += 1
+        for next_location, road_distance in roads_from[location].items():
+            if next_location == skipped_node:
+                continue
+            next_distance = distance + road_distance
+            if next_distance < distances.get(
+                    next_location, next_distance + 1):
+                distances[next_location] = next_distance
+                heapq.heappush(location_queue, (next_distance, next_location))
+    return distances
+
+
+def build_csr(
+        node_count: int, node_roads: list[dict[int, int]]
+        ) -> tuple[array, array, array]:
+    offsets = array("q", [0])
+    targets = array("q")
+    distances = array("q")
+    for node in range(node_count):
+        for next_node, distance in node_roads[node].items():
+            targets.append(next_node)
+            distances.append(distance)
+        offsets.append(len(targets))
+    return offsets, targets, distances
@@ -0,0 +1,201 @@
+import heapq
+from collections import OrderedDict
+from typing import NamedTuple
+
+from sqlmodel import Session
+
+from ..models.company import Company
+from ..models.storage import Storage
+from .road_graph import RoadGraph, get_road_graph
+from .reachability import get_reachability_index
+from .capacity_index import CapacityIndex, load_capacity_index
+from .contraction_hierarchy import get_contraction_hierarchy
+
+
+class StorageDistance(NamedTuple):
+    distance: int
+    # Number of storages along the route, including the last one
+    route_length: int
+
+
+# Max number of companies with cached distance tables
+DISTANCE_TABLES_MAX_SIZE = 1024
+
+
+def get_storage_distance(
+        session: Session, company: Company, storage: Storage,
+        use_contraction_hierarchy: bool = False
+        ) -> int | None:
+    """ Shortest distance from company to storage (None if unreachable).
+    Until contraction hierarchy is ready, distance table of the company
+    is used (computed with one search and cached)
+    """
+    graph = get_road_graph(session=session)
+    company_location = graph.company_nodes[company.id]
+    storage_location = graph.storage_nodes[storage.id]
+    # Unreachable storages are rejected without a search
+    reachability_index = get_reachability_index(graph=graph)
+    if not reachability_index.is_reachable(
+            source=company_location, target=storage_location):
+        return None
+    if use_contraction_hierarchy:
+        contraction_hierarchy = get_contraction_hierarchy(graph=graph)
+        if contraction_hierarchy is not None:
+            return contraction_hierarchy.find_distance(
+                source=company_location, target=storage_location)
+    distance_table = get_distance_table(session=session, company=company)
+    storage_distance = distance_table.get(storage.id)
+    if storage_distance is None:
+        return None
+    return storage_distance.distance
+
+
+def get_distance_table(
+        session: Session, company: Company) -> dict[int, StorageDistance]:
+    """ Shortest distances from company to every reachable storage.
+    Computed with one search and cached with the road network snapshot
+    """
+    graph = get_road_graph(session=session)
+    distance_table = get_cached_distance_table(
+        graph=graph, company_id=company.id)
+    if distance_table is not None:
+        return distance_table
+    distance_table = find_storage_distances(
+        graph=graph, source=graph.company_nodes[company.id])
+    with graph.indexes_lock:
+        distance_tables = graph.indexes["distance_tables"]
+        distance_tables[company.id] = distance_table
+        if len(distance_tables) > DISTANCE_TABLES_MAX_SIZE:
+            distance_tables.popitem(last=False)
+    return distance_table
+
+
+def get_cached_distance_table(
+        graph: RoadGraph, company_id: int
+        ) -> dict[int, StorageDistance] | None:
+    with graph.indexes_lock:
+        # company id -> {storage id: distance}, least recently used first
+        distance_tables = graph.indexes.setdefault(
+            "distance_tables", OrderedDict())
+        distance_table = distance_tables.get(company_id)
+        if distance_table is not None:
+            distance_tables.move_to_end(company_id)
+    return distance_table
+
+
+def find_storage_distances(
+        graph: RoadGraph, source: int) -> dict[int, StorageDistance]:
+    """ Single-source search (Dijkstra) from node to all storages """
+    distances = {}
+    location_queue = [(0, 0, source)]
+    visited_locations = set()
+    while location_queue:
+        distance, route_length, location = heapq.heappop(location_queue)
+        if location in visited_locations:
+            continue
+        visited_locations.add(location)
+        if location != source:
+            distances[graph.storage_ids[location]] = StorageDistance(
+                distance=distance, route_length=route_length)
+        for next_location, road_distance in graph.roads_from(location):
+            if next_location not in visited_locations:
+                heapq.heappush(
+                    location_queue,
+                    (distance + road_distance, route_length + 1,
+                     next_location)
+                    )
+    return distances
+
+
+def get_company_distances(
+        session: Session, storage: Storage) -> dict[int, int]:
+    """ Shortest distances to storage from every company, that can reach
+    it (company id -> distance)
+    """
+    graph = get_road_graph(session=session)
+    distances = find_distances_to(
+        graph=graph, target=graph.storage_nodes[storage.id])
+    return {
+        company_id: distances[company_location]
+        for company_id, company_location in graph.company_nodes.items()
+        if company_location in distances
+        }
+
+
+def find_distances_to(graph: RoadGraph, target: int) -> dict[int, int]:
+    """ Single-target search (reverse Dijkstra) from node to all locations,
+    that can reach it. Only storages lead to other locations, so routes
+    pass only through storages
+    """
+    distances = {}
+    location_queue = [(0, target)]
+    while location_queue:
+        distance, location = heapq.heappop(location_queue)
+        if location in distances:
+            continue
+        distances[location] = distance
+        for previous_location, road_distance in graph.roads_to(location):
+            if previous_location not in distances:
+                heapq.heappush(
+                    location_queue,
+                    (distance + road_distance, previous_location)
+                    )
+    del distances[target]
+    return distances
+
+
+def get_nearest_storages(
+        session: Session, company: Company, waste_id: int,
+        min_free_amount: int, k: int
+        ) -> dict[int, StorageDistance]:
+    """ Up to k nearest storages, that have at least "min_free_amount" of
+    free space for waste type (storage id -> distance, nearest first)
+    """
+    graph = get_road_graph(session=session)
+    source = graph.company_nodes[company.id]
+    capacity_index = load_capacity_index(
+        session=session, waste_ids=[waste_id])
+    # Search stops after all reachable qualifying storages are found
+    reachable = get_reachability_index(graph=graph).reachable_storages(
+        source=source)
+    qualifying_count = 0
+    for (storage_id, _), free_space in capacity_index.items():
+        storage_node = graph.storage_nodes.get(storage_id)
+        if (free_space >= min_free_amount and storage_node is not None
+                and reachable >> storage_node & 1):
+            qualifying_count += 1
+    return find_nearest_storages(
+        graph=graph, source=source, capacity_index=capacity_index,
+        waste_id=waste_id, min_free_amount=min_free_amount,
+        k=min(k, qualifying_count)
+        )
+
+
+def find_nearest_storages(
+        graph: RoadGraph, source: int, capacity_index: CapacityIndex,
+        waste_id: int, min_free_amount: int, k: int
+        ) -> dict[int, StorageDistance]:
+    """ Search (Dijkstra) from node, that stops as soon as k storages with
+    enough free space are settled
+    """
+    storages = {}
+    location_queue = [(0, 0, source)]
+    visited_locations = set()
+    while location_queue and len(storages) < k:
+        distance, route_length, location = heapq.heappop(location_queue)
+        if location in visited_locations:
+            continue
+        visited_locations.add(location)
+        storage_id = graph.storage_ids[location]
+        if location != source and capacity_index.get(
+                (storage_id, waste_id), 0) >= min_free_amount:
+            storages[storage_id] = StorageDistance(
+                distance=distance, route_length=route_length)
+        for next_location, road_distance in graph.roads_from(location):
+            if next_location not in visited_locations:
+                heapq.heappush(
+                    location_queue,
+                    (distance + road_distance, route_length + 1,
+                     next_location)
+                    )
+    return storages
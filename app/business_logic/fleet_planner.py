@@ -0,0 +1,71 @@
+import time
+
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+
+from ..models.company import Company
+from ..models.route import CompanyRoutePlan, FleetRoutePlan
+from .capacity_index import load_capacity_index
+from .optimal_route import (
+    SearchStats, SearchBudget, SearchLimitExceeded, find_optimal_unload_route)
+from .reachability import build_free_space_bits
+from .road_graph import get_road_graph
+
+
+def plan_fleet_unload(
+        session: Session, company_ids: list[int] | None = None,
+        reserve_capacity: bool = False, budget: SearchBudget | None = None
+        ) -> FleetRoutePlan:
+    """ Plan unload routes (all waste types to one storage) for companies.
+    All searches share one road network snapshot and capacity index.
+    With "reserve_capacity" planned waste is deducted from the capacity
+    index, so companies are not sent to the same storage beyond its space.
+    Budget limits every search, companies without a route found within it
+    are left without a plan
+    """
+    start = time.perf_counter()
+    graph = get_road_graph(session=session)
+    capacity_index = load_capacity_index(session=session)
+    free_space_bits = build_free_space_bits(
+        graph=graph, capacity_index=capacity_index)
+    statement = select(Company).options(
+        selectinload(Company.waste_links)).order_by(Company.id)
+    if company_ids is not None:
+        statement = statement.where(Company.id.in_(company_ids))
+    plans = []
+    total_expansions = 0
+    for company in session.exec(statement):
+        stats = SearchStats()
+        route = None
+        waste_amount = sum(
+            waste_link.amount for waste_link in company.waste_links)
+        # Companies without location or waste are not routed
+        if company.id in graph.company_nodes and waste_amount > 0:
+            try:
+                route = find_optimal_unload_route(
+                    session=session, company=company,
+                    company_waste_links=company.waste_links,
+                    partial_unload=False, capacity_index=capacity_index,
+                    graph=graph, stats=stats, budget=budget,
+                    free_space_bits=free_space_bits
+                    )
+            except SearchLimitExceeded:
+                route = None
+        if route is not None and reserve_capacity:
+            storage_id = route.route_history[-1].id
+            for waste_link in company.waste_links:
+                key = (storage_id, waste_link.waste_id)
+                if key in capacity_index:
+                    capacity_index[key] -= waste_link.amount
+                    if capacity_index[key] <= 0:
+                        free_space_bits[waste_link.waste_id] = (
+                            free_space_bits.get(waste_link.waste_id, 0)
+                            & ~(1 << graph.storage_nodes[storage_id])
+                            )
+        plans.append(CompanyRoutePlan(
+            company_id=company.id, route=route, expansions=stats.expansions))
+        total_expansions += stats.expansions
+    return FleetRoutePlan(
+        plans=plans, runtime_ms=(time.perf_counter() - start) * 1000,
+        expansions=total_expansions
+        )
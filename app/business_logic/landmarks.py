@@ -0,0 +1,218 @@
+import heapq
+from array import array
+from typing import TYPE_CHECKING
+
+from .road_graph import RoadGraph
+
+if TYPE_CHECKING:
+    from .optimal_route import SearchStats
+
+
+# Number of landmark storages
+LANDMARK_COUNT = 8
+
+# Distance value for unreachable nodes in landmark tables
+UNREACHABLE = -1
+
+
+class LandmarkIndex:
+    """ Distances from and to a few landmark storages (ALT). By triangle
+    inequality they give lower bounds of distance between any two nodes
+    """
+
+    def __init__(
+            self, landmarks: list[int], distances_from: list[array],
+            distances_to: list[array]
+            ):
+        self.landmarks = landmarks
+        # For every landmark: distances from landmark to every node
+        self.distances_from = distances_from
+        # For every landmark: distances from every node to landmark
+        self.distances_to = distances_to
+
+    def lower_bound(self, source: int, target: int) -> int | None:
+        """ Lower bound of distance from source to target (None if target
+        can not be reached from source)
+        """
+        bound = 0
+        for distances_from, distances_to in zip(
+                self.distances_from, self.distances_to):
+            from_source = distances_from[source]
+            from_target = distances_from[target]
+            if from_source != UNREACHABLE:
+                # Landmark reaches target through source
+                if from_target == UNREACHABLE:
+                    return None
+                bound = max(bound, from_target - from_source)
+            to_source = distances_to[source]
+            to_target = distances_to[target]
+            if to_target != UNREACHABLE:
+                # Source reaches landmark through target
+                if to_source == UNREACHABLE:
+                    return None
+                bound = max(bound, to_source - to_target)
+        return bound
+
+
+def get_landmark_index(graph: RoadGraph) -> LandmarkIndex:
+    """ Landmark index, cached with the road network snapshot (so it is
+    built again after the road network changes)
+    """
+    with graph.indexes_lock:
+        landmark_index = graph.indexes.get("landmark_index")
+        if landmark_index is None:
+            landmark_index = build_landmark_index(graph=graph)
+            graph.indexes["landmark_index"] = landmark_index
+    return landmark_index
+
+
+def build_landmark_index(
+        graph: RoadGraph, landmark_count: int = LANDMARK_COUNT
+        ) -> LandmarkIndex:
+    """ Select landmarks greedily: every next landmark is the storage
+    farthest from already selected ones (unreachable storages first)
+    """
+    storage_nodes = sorted(graph.storage_nodes.values())
+    landmarks = []
+    distances_from = []
+    distances_to = []
+    # Distance from the nearest selected landmark to every storage
+    nearest_distances = {node: None for node in storage_nodes}
+    while nearest_distances and len(landmarks) < landmark_count:
+        landmark = max(
+            nearest_distances,
+            key=lambda node: (nearest_distances[node] is None,
+                              nearest_distances[node] or 0, -node)
+            )
+        del nearest_distances[landmark]
+        landmarks.append(landmark)
+        distances_from.append(find_node_distances(
+            graph=graph, source=landmark, reverse=False))
+        distances_to.append(find_node_distances(
+            graph=graph, source=landmark, reverse=True))
+        for node, nearest_distance in nearest_distances.items():
+            distance = distances_from[-1][node]
+            if distance != UNREACHABLE and (
+                    nearest_distance is None or distance < nearest_distance):
+                nearest_distances[node] = distance
+    return LandmarkIndex(
+        landmarks=landmarks, distances_from=distances_from,
+        distances_to=distances_to
+        )
+
+
+def find_node_distances(
+        graph: RoadGraph, source: int, reverse: bool) -> array:
+    """ Shortest distances from source to every node (to source from every
+    node for reverse search)
+    """
+    if reverse:
+        offsets, targets, road_distances = graph.reverse_roads()
+    else:
+        offsets, targets, road_distances = (
+            graph.offsets, graph.targets, graph.distances)
+    distances = array("q", [UNREACHABLE]) * len(graph)
+    location_queue = [(0, source)]
+    while location_queue:
+        distance, location = heapq.heappop(location_queue)
+        if distances[location] != UNREACHABLE:
+            continue
+        distances[location] = distance
+        for position in range(offsets[location], offsets[location + 1]):
+            next_location = targets[position]
+            if distances[next_location] == UNREACHABLE:
+                heapq.heappush(
+                    location_queue,
+                    (distance + road_distances[position], next_location)
+                    )
+    return distances
+
+
+def find_landmark_path(
+        graph: RoadGraph, landmark_index: LandmarkIndex, source: int,
+        target: int, stats: "SearchStats | None" = None
+        ) -> tuple[list[int], int] | None:
+    """ Shortest route from source to target (bidirectional A* with
+    landmark lower bounds). Returns nodes along the route and distance
+
+    Both searches use the average of lower bounds to target and from
+    source as potential, so potentials are consistent for both directions.
+    Keys are doubled to stay integer
+    """
+    if landmark_index.lower_bound(source=source, target=target) is None:
+        return None
+    # Potential of nodes: bound to target - bound from source
+    # (None for nodes, that are not on any route from source to target)
+    potentials = {}
+
+    def get_potential(node: int) -> int | None:
+        if node not in potentials:
+            to_target = landmark_index.lower_bound(source=node, target=target)
+            from_source = landmark_index.lower_bound(
+                source=source, target=node)
+            if to_target is None or from_source is None:
+                potentials[node] = None
+            else:
+                potentials[node] = to_target - from_source
+        return potentials[node]
+
+    # Forward search from source and reverse search from target
+    distances = ({source: 0}, {target: 0})
+    parents = ({source: None}, {target: None})
+    settled_locations = (set(), set())
+    location_queues = (
+        [(get_potential(source), source)], [(-get_potential(target), target)])
+    best_distance = None
+    meeting_location = None
+    while location_queues[0] and location_queues[1]:
+        if best_distance is not None and (
+                location_queues[0][0][0] + location_queues[1][0][0]
+                >= 2 * best_distance):
+            break
+        # Expand the search with the smaller frontier
+        side = 0 if len(location_queues[0]) <= len(location_queues[1]) else 1
+        _, location = heapq.heappop(location_queues[side])
+        if location in settled_locations[side]:
+            continue
+        settled_locations[side].add(location)
+        if stats is not None:
+            stats.expansions += 1
+        if side == 0:
+            roads = graph.roads_from(location)
+        else:
+            roads = graph.roads_to(location)
+        distance = distances[side][location]
+        for next_location, road_distance in roads:
+            if next_location in settled_locations[side]:
+                continue
+            potential = get_potential(next_location)
+            if potential is None:
+                continue
+            next_distance = distance + road_distance
+            if next_distance < distances[side].get(
+                    next_location, next_distance + 1):
+                distances[side][next_location] = next_distance
+                parents[side][next_location] = location
+                key = 2 * next_distance + (
+                    potential if side == 0 else -potential)
+                heapq.heappush(location_queues[side], (key, next_location))
+                other_distance = distances[1 - side].get(next_location)
+                if other_distance is not None and (
+                        best_distance is None
+                        or next_distance + other_distance < best_distance):
+                    best_distance = next_distance + other_distance
+                    meeting_location = next_location
+    if best_distance is None:
+        return None
+
+    nodes = []
+    location = meeting_location
+    while location is not None:
+        nodes.append(location)
+        location = parents[0][location]
+    nodes.reverse()
+    location = parents[1][meeting_location]
+    while location is not None:
+        nodes.append(location)
+        location = parents[1][location]
+    return nodes, best_distance
@@ -0,0 +1,354 @@
+import heapq
+import time
+from dataclasses import dataclass
+
+from sqlmodel import Session
+
+from ..models.company import Company
+from ..models.companywastelink import CompanyWasteLink
+from ..models.route import RoutePublic
+from .road_graph import RoadGraph, get_road_graph
+from .capacity_index import CapacityIndex, load_capacity_index
+from .reachability import (
+    get_reachability_index, build_free_space_bits, has_reachable_capacity)
+from .optimal_route import (
+    SearchStats, SearchBudget, SearchLimitExceeded, build_search_result,
+    route_order
+    )
+
+
+@dataclass(slots=True)
+class MultiWasteRoute:
+    """ Search label for unloading several waste types along one route """
+    next_location: int
+    distance: int
+    previous_route: "MultiWasteRoute | None"
+    # Empty space along the route for every waste type, capped by
+    # company waste amount
+    space_counters: tuple[int, ...]
+    # Bitset of storages, whose space is counted (bits are numbered as in
+    # StorageSpace.storages, not by nodes)
+    used_storages: int
+    # Set when a better label reaches the same location
+    dominated: bool = False
+
+
+class StorageSpace:
+    """ Free space of storages for the searched waste types. Storages with
+    free space for any of them are numbered with dense bit indices
+    """
+
+    def __init__(
+            self, graph: RoadGraph, capacity_index: CapacityIndex,
+            waste_ids: list[int], waste_amounts: tuple[int, ...]
+            ):
+        self.waste_amounts = waste_amounts
+        waste_indexes = {
+            waste_id: waste_index
+            for waste_index, waste_id in enumerate(waste_ids)
+            }
+        # For every waste type: nodes of storages with free space for it
+        self.waste_nodes = [[] for _ in waste_ids]
+        node_spaces = {}
+        for (storage_id, waste_id), free_space in capacity_index.items():
+            waste_index = waste_indexes.get(waste_id)
+            node = graph.storage_nodes.get(storage_id)
+            if waste_index is None or node is None or free_space <= 0:
+                continue
+            free_spaces = node_spaces.setdefault(node, [0] * len(waste_ids))
+            free_spaces[waste_index] = free_space
+            self.waste_nodes[waste_index].append(node)
+        # node -> (bit, free space for every waste type)
+        self.storages = {
+            node: (bit, tuple(free_spaces))
+            for bit, (node, free_spaces) in enumerate(node_spaces.items())
+            }
+
+    def extend_route(
+            self, route: MultiWasteRoute, next_location: int,
+            road_distance: int
+            ) -> MultiWasteRoute:
+        """ Route to the next location. Storage space can be counted only
+        once along the route
+        """
+        space_counters = route.space_counters
+        used_storages = route.used_storages
+        storage = self.storages.get(next_location)
+        if storage is not None and not used_storages >> storage[0] & 1:
+            bit, free_spaces = storage
+            space_counters = tuple(
+                min(total_empty_space + free_space, waste_amount)
+                for total_empty_space, free_space, waste_amount in zip(
+                    route.space_counters, free_spaces, self.waste_amounts)
+                )
+            # Storage without space for lacking waste types is kept free
+            # for the rest of the route
+            if space_counters != route.space_counters:
+                used_storages |= 1 << bit
+        return MultiWasteRoute(
+            next_location=next_location,
+            distance=route.distance + road_distance, previous_route=route,
+            space_counters=space_counters, used_storages=used_storages
+            )
+
+    def is_complete(self, route: MultiWasteRoute) -> bool:
+        return route.space_counters == self.waste_amounts
+
+
+class StorageDistanceBound:
+    """ Distances from nodes to the nearest storage with free space for
+    a waste type (multi-source Dijkstra over reverse roads). The search
+    is resumed only until the requested node is settled, so only nodes
+    around the searched routes are visited
+    """
+
+    def __init__(self, graph: RoadGraph, storage_nodes: list[int]):
+        self.graph = graph
+        self.distances = {}
+        self.location_queue = [(0, node) for node in storage_nodes]
+        heapq.heapify(self.location_queue)
+
+    def get(self, node: int) -> int | None:
+        """ Distance to the nearest storage (None if it can not be
+        reached from node)
+        """
+        while node not in self.distances and self.location_queue:
+            distance, location = heapq.heappop(self.location_queue)
+            if location in self.distances:
+                continue
+            self.distances[location] = distance
+            for previous_location, road_distance in self.graph.roads_to(
+                    location):
+                if previous_location not in self.distances:
+                    heapq.heappush(
+                        self.location_queue,
+                        (distance + road_distance, previous_location)
+                        )
+        return self.distances.get(node)
+
+
+def find_multi_waste_unload_route(
+        session: Session, company: Company,
+        company_waste_links: list[CompanyWasteLink],
+        capacity_index: CapacityIndex | None = None,
+        graph: RoadGraph | None = None, stats: SearchStats | None = None,
+        budget: SearchBudget | None = None,
+        free_space_bits: dict[int, int] | None = None
+        ) -> RoutePublic | None:
+    """ Find optimal (with distance minimized) route, that unloads all
+    waste types partially into storages along the way
+
+    Route may pass a storage several times, but its space is counted
+    once. Every location keeps a set of routes, that are not dominated by
+    another route with shorter distance, the same space for every waste
+    type and a subset of storages with counted space. Space counters are
+    capped by waste amounts, so routes with enough space for a waste type
+    are not distinguished by it. Routes are expanded in order of distance
+    plus lower bound of the remaining distance: distance to the nearest
+    storage with free space for every waste type, that still lacks it
+    (A*). Search budget is handled as in find_optimal_unload_route()
+    """
+    start = time.perf_counter()
+    if stats is None:
+        stats = SearchStats()
+    if graph is None:
+        graph = get_road_graph(session=session)
+    company_location = graph.company_nodes[company.id]
+    waste_ids = [waste_link.waste_id for waste_link in company_waste_links]
+    waste_amounts = tuple(
+        waste_link.amount for waste_link in company_waste_links)
+    if capacity_index is None:
+        capacity_index = load_capacity_index(
+            session=session, waste_ids=waste_ids)
+    # Reject without a search if some waste type can not be unloaded
+    reachability_index = get_reachability_index(graph=graph)
+    if free_space_bits is None:
+        free_space_bits = build_free_space_bits(
+            graph=graph, capacity_index=capacity_index)
+    for waste_id, waste_amount in zip(waste_ids, waste_amounts):
+        if waste_amount > 0 and not has_reachable_capacity(
+                reachability_index=reachability_index,
+                source=company_location, free_space_bits=free_space_bits,
+                waste_id=waste_id):
+            return None
+    storage_space = StorageSpace(
+        graph=graph, capacity_index=capacity_index, waste_ids=waste_ids,
+        waste_amounts=waste_amounts
+        )
+    # Reject without a search if reachable storages have not enough space
+    reachable = reachability_index.reachable_storages(
+        source=company_location)
+    total_spaces = [0] * len(waste_ids)
+    for node, (_, free_spaces) in storage_space.storages.items():
+        if reachable >> node & 1:
+            for waste_index, free_space in enumerate(free_spaces):
+                total_spaces[waste_index] += free_space
+    if any(total_space < waste_amount for total_space, waste_amount in zip(
+            total_spaces, waste_amounts)):
+        return None
+    distance_bounds = [
+        StorageDistanceBound(graph=graph, storage_nodes=storage_nodes)
+        for storage_nodes in storage_space.waste_nodes
+        ]
+
+    # Non-dominated routes for every location and space counters
+    location_routes = {}
+    route_queue = []
+    # Shortest complete route among generated ones
+    complete_route = None
+    route = MultiWasteRoute(
+        next_location=company_location, distance=0, previous_route=None,
+        space_counters=(0,) * len(waste_ids), used_storages=0
+        )
+    heapq.heappush(route_queue, (0, 0, next(route_order), route))
+    while route_queue:
+        _, _, _, route = heapq.heappop(route_queue)
+        if route.dominated:
+            continue
+        stats.expansions += 1
+        if storage_space.is_complete(route=route):
+            return build_search_result(
+                session=session, route=route, graph=graph, stats=stats,
+                start=start
+                )
+        if budget is not None and budget.is_exhausted(
+                stats=stats, start=start):
+            # The most promising route is completed greedily
+            greedy_route = complete_route_greedily(
+                graph=graph, storage_space=storage_space, route=route)
+            if greedy_route is not None and (
+                    complete_route is None
+                    or greedy_route.distance < complete_route.distance):
+                complete_route = greedy_route
+            if complete_route is None:
+                raise SearchLimitExceeded
+            return build_search_result(
+                session=session, route=complete_route, graph=graph,
+                stats=stats, start=start, approximate=True
+                )
+        for next_location, road_distance in graph.roads_from(
+                route.next_location):
+            new_route = storage_space.extend_route(
+                route=route, next_location=next_location,
+                road_distance=road_distance
+                )
+            bound = find_distance_bound(
+                location=next_location,
+                space_counters=new_route.space_counters,
+                waste_amounts=waste_amounts, distance_bounds=distance_bounds
+                )
+            # Lacking waste types can not be unloaded anymore
+            if bound is None:
+                continue
+            if add_route(
+                    location_routes=location_routes, new_route=new_route):
+                # Of routes with equal estimates, longer ones are closer to
+                # complete
+                heapq.heappush(
+                    route_queue,
+                    (new_route.distance + bound, -new_route.distance,
+                     next(route_order), new_route)
+                    )
+                if storage_space.is_complete(route=new_route) and (
+                        complete_route is None
+                        or new_route.distance < complete_route.distance):
+                    complete_route = new_route
+        stats.open_set_peak = max(stats.open_set_peak, len(route_queue))
+    return None
+
+
+def complete_route_greedily(
+        graph: RoadGraph, storage_space: StorageSpace,
+        route: MultiWasteRoute
+        ) -> MultiWasteRoute | None:
+    """ Complete route by going to the nearest storage with space for
+    a lacking waste type, until there is enough space for every waste type
+    (None if storages with space can not be reached)
+    """
+    while not storage_space.is_complete(route=route):
+        # Dijkstra from the route end to the nearest useful storage
+        distances = {route.next_location: 0}
+        # location -> (previous location, road distance)
+        parents = {}
+        settled_locations = set()
+        location_queue = [(0, route.next_location)]
+        target = None
+        while location_queue:
+            distance, location = heapq.heappop(location_queue)
+            if location in settled_locations:
+                continue
+            settled_locations.add(location)
+            if location != route.next_location and storage_space.extend_route(
+                    route=route, next_location=location, road_distance=0
+                    ).space_counters != route.space_counters:
+                target = location
+                break
+            for next_location, road_distance in graph.roads_from(location):
+                next_distance = distance + road_distance
+                if next_distance < distances.get(
+                        next_location, next_distance + 1):
+                    distances[next_location] = next_distance
+                    parents[next_location] = (location, road_distance)
+                    heapq.heappush(
+                        location_queue, (next_distance, next_location))
+        if target is None:
+            return None
+        path = []
+        while target != route.next_location:
+            previous_location, road_distance = parents[target]
+            path.append((target, road_distance))
+            target = previous_location
+        for next_location, road_distance in reversed(path):
+            route = storage_space.extend_route(
+                route=route, next_location=next_location,
+                road_distance=road_distance
+                )
+    return route
+
+
+def find_distance_bound(
+        location: int, space_counters: tuple[int, ...],
+        waste_amounts: tuple[int, ...],
+        distance_bounds: list[StorageDistanceBound]
+        ) -> int | None:
+    """ Lower bound of the distance, that route from location has to
+    travel to get enough space for every waste type (None if some waste
+    type can not get it)
+    """
+    bound = 0
+    for total_empty_space, waste_amount, distance_bound in zip(
+            space_counters, waste_amounts, distance_bounds):
+        if total_empty_space < waste_amount:
+            distance = distance_bound.get(node=location)
+            if distance is None:
+                return None
+            bound = max(bound, distance)
+    return bound
+
+
+def add_route(
+        location_routes: dict[tuple, list[MultiWasteRoute]],
+        new_route: MultiWasteRoute
+        ) -> bool:
+    """ Add route to the set of non-dominated routes to its location.
+    Space counters are determined by storages with counted space, so a
+    route can be dominated only by routes with the same counters, only
+    they are compared. Routes dominated by the new one are marked and
+    deleted lazily
+    """
+    key = (new_route.next_location, new_route.space_counters)
+    routes = location_routes.setdefault(key, [])
+    for route in routes:
+        if (route.distance <= new_route.distance
+                and route.used_storages & ~new_route.used_storages == 0):
+            return False
+    kept_routes = []
+    for route in routes:
+        if (new_route.distance <= route.distance
+                and new_route.used_storages & ~route.used_storages == 0):
+            route.dominated = True
+        else:
+            kept_routes.append(route)
+    kept_routes.append(new_route)
+    location_routes[key] = kept_routes
+    return True
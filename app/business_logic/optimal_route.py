@@ -1,243 +1,515 @@
-from collections import deque
+import heapq
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from itertools import count
 
-from sqlmodel import Session
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
 
 from ..models.company import Company
 from ..models.storage import Storage
-from ..models.location import Location
 from ..models.companywastelink import CompanyWasteLink
 from ..models.storagewastelink import StorageWasteLink
-from ..models.route import Route, SpaceCounter
+from ..models.route import RoutePublic, SearchStatsPublic
 from .. import crud
+from .road_graph import RoadGraph, get_road_graph
+from .capacity_index import (
+    CapacityIndex, load_capacity_index, bump_capacity_version)
+from .reachability import (
+    get_reachability_index, build_free_space_bits, has_reachable_capacity)
+from .landmarks import get_landmark_index, find_landmark_path
+from .transfer_ledger import record_transfers
+
+
+@dataclass(slots=True)
+class Route:
+    """ Search label, lightweight counterpart of RoutePublic """
+    # Location index in the road graph snapshot
+    next_location: int
+    distance: int
+    # Parent pointer, storage list is built only for the found route
+    previous_route: "Route | None" = None
+    # Total empty space along the route for every company waste link
+    space_counters: tuple[int, ...] | None = None
+
+
+@dataclass(slots=True)
+class SearchStats:
+    """ Search work counters """
+    # Number of routes popped from the route queue
+    expansions: int = 0
+    # Max number of routes in the route queue
+    open_set_peak: int = 0
+    elapsed_ms: float = 0
+
+
+@dataclass(slots=True)
+class SearchBudget:
+    """ Search limits (None for no limit) """
+    max_expansions: int | None = None
+    time_limit_ms: float | None = None
+
+    def is_exhausted(self, stats: SearchStats, start: float) -> bool:
+        if (self.max_expansions is not None
+                and stats.expansions >= self.max_expansions):
+            return True
+        return (self.time_limit_ms is not None
+                and (time.perf_counter() - start) * 1000
+                >= self.time_limit_ms)
+
+
+class SearchLimitExceeded(Exception):
+    """ Search budget is exhausted before any route is found """
+
+
+class UnloadConflict(Exception):
+    """ Storages have not enough space for unloading anymore """
+
+
+# Tie breaker for routes with equal distance in the route queue
+route_order = count()
 
 
 def find_optimal_unload_route(
-        company: Company, company_waste_links: list[CompanyWasteLink],
-        partial_unload: bool
-        ) -> Route | None:
+        session: Session, company: Company,
+        company_waste_links: list[CompanyWasteLink], partial_unload: bool,
+        capacity_index: CapacityIndex | None = None,
+        graph: RoadGraph | None = None, stats: SearchStats | None = None,
+        budget: SearchBudget | None = None,
+        free_space_bits: dict[int, int] | None = None
+        ) -> RoutePublic | None:
     """ Find optimal (with distance minimized) route, for waste unloading
     allows for partial unloading along the way
+
+    When budget is exhausted, the shortest complete route found so far is
+    returned as approximate (SearchLimitExceeded is raised if none).
+    Free space bitsets (see build_free_space_bits()) must match the
+    capacity index, they are built from it if not passed
     """
-    routes_to_explore = set()
+    start = time.perf_counter()
+    if stats is None:
+        stats = SearchStats()
+    # Best tentative route for every location (decrease-key index)
+    best_routes = {}
+    route_queue = []
     visited_locations = set()
-    company_location = company.location_link.location
+    # Shortest complete route among generated ones
+    complete_route = None
+    if graph is None:
+        graph = get_road_graph(session=session)
+    company_location = graph.company_nodes[company.id]
 
-    space_counters = []
-    for company_waste_link in company_waste_links:
-        space_counter = SpaceCounter(
-            company_waste_link=company_waste_link, total_empty_space=0)
-        space_counters.append(space_counter)
+    waste_ids = [waste_link.waste_id for waste_link in company_waste_links]
+    waste_amounts = [waste_link.amount for waste_link in company_waste_links]
+    if capacity_index is None:
+        capacity_index = load_capacity_index(
+            session=session, waste_ids=waste_ids)
+    # Reject without a search if some waste type can not be unloaded
+    reachability_index = get_reachability_index(graph=graph)
+    if free_space_bits is None:
+        free_space_bits = build_free_space_bits(
+            graph=graph, capacity_index=capacity_index)
+    for waste_id, waste_amount in zip(waste_ids, waste_amounts):
+        if waste_amount > 0 and not has_reachable_capacity(
+                reachability_index=reachability_index,
+                source=company_location, free_space_bits=free_space_bits,
+                waste_id=waste_id):
+            return None
 
     route = Route(
-        next_location=company_location, route_history=[], distance=0,
-        space_counters=space_counters
+        next_location=company_location, distance=0,
+        space_counters=(0,) * len(company_waste_links)
         )
     routes = find_routes(
-        route=route, visited_locations=visited_locations,
+        route=route, visited_locations=visited_locations, graph=graph,
+        capacity_index=capacity_index, waste_ids=waste_ids,
         partial_unload=partial_unload
         )
     if not routes:
         return None
-    routes_to_explore.update(routes)
-
-    while routes_to_explore:
-        shortest_route = min(routes_to_explore)
-        for space_counter in shortest_route.space_counters:
-            total_empty_space = space_counter.total_empty_space
-            waste_amount = space_counter.company_waste_link.amount
-            if total_empty_space < waste_amount:
-                break
-        else:
-            return shortest_route
+    complete_route = find_shortest_complete_route(
+        routes=routes, waste_amounts=waste_amounts,
+        complete_route=complete_route
+        )
+    merge_routes(
+        best_routes=best_routes, new_routes=routes, route_queue=route_queue)
+    stats.open_set_peak = max(stats.open_set_peak, len(route_queue))
+
+    while True:
+        shortest_route = pop_shortest_route(
+            best_routes=best_routes, route_queue=route_queue)
+        if shortest_route is None:
+            return None
+        stats.expansions += 1
+        if is_complete_route(
+                route=shortest_route, waste_amounts=waste_amounts):
+            return build_search_result(
+                session=session, route=shortest_route, graph=graph,
+                stats=stats, start=start
+                )
+        if budget is not None and budget.is_exhausted(
+                stats=stats, start=start):
+            if complete_route is None:
+                raise SearchLimitExceeded
+            return build_search_result(
+                session=session, route=complete_route, graph=graph,
+                stats=stats, start=start, approximate=True
+                )
 
-        routes_to_explore.discard(shortest_route)
         location = shortest_route.next_location
         visited_locations.add(location)
 
         new_routes = find_routes(
             route=shortest_route, visited_locations=visited_locations,
+            graph=graph, capacity_index=capacity_index, waste_ids=waste_ids,
             partial_unload=partial_unload
             )
+        complete_route = find_shortest_complete_route(
+            routes=new_routes, waste_amounts=waste_amounts,
+            complete_route=complete_route
+            )
         # Filtering out routes by distance to the same location
-        filter_and_merge_routes(
-            routes_to_explore=routes_to_explore, new_routes=new_routes)
-    return None
+        merge_routes(
+            best_routes=best_routes, new_routes=new_routes,
+            route_queue=route_queue
+            )
+        stats.open_set_peak = max(stats.open_set_peak, len(route_queue))
 
 
-def find_optimal_storage_route(company: Company, storage: Storage) -> Route:
+def find_optimal_storage_route(
+        session: Session, company: Company, storage: Storage,
+        stats: SearchStats | None = None
+        ) -> RoutePublic | None:
     """ Find optimal (with distance minimized) route to specified storage """
-    routes_to_explore = set()
-    visited_locations = set()
-
-    company_location = company.location_link.location
-    storage_location = storage.location_link.location
+    graph = get_road_graph(session=session)
+    company_location = graph.company_nodes[company.id]
+    storage_location = graph.storage_nodes[storage.id]
+    # Reject unreachable storage without a search
+    reachability_index = get_reachability_index(graph=graph)
+    if not reachability_index.is_reachable(
+            source=company_location, target=storage_location):
+        return None
 
-    route = Route(
-        next_location=company_location, route_history=[], distance=0)
-    routes = find_routes(
-        route=route, visited_locations=visited_locations)
-    if not routes:
+    # Goal-directed search, target is known
+    landmark_index = get_landmark_index(graph=graph)
+    path = find_landmark_path(
+        graph=graph, landmark_index=landmark_index, source=company_location,
+        target=storage_location, stats=stats
+        )
+    if path is None:
         return None
-    routes_to_explore.update(routes)
+    locations, distance = path
+    return build_route_from_storages(
+        session=session,
+        storage_ids=[graph.storage_ids[location]
+                     for location in locations[1:]],
+        distance=distance
+        )
 
-    while routes_to_explore:
-        shortest_route = min(routes_to_explore)
-        if shortest_route.next_location == storage_location:
-            return shortest_route
 
-        routes_to_explore.discard(shortest_route)
-        location = shortest_route.next_location
-        visited_locations.add(location)
+def is_complete_route(route: Route, waste_amounts: list[int]) -> bool:
+    """ Check if route has enough empty space for every waste type """
+    return all(
+        total_empty_space >= waste_amount
+        for total_empty_space, waste_amount in zip(
+            route.space_counters, waste_amounts)
+        )
 
-        new_routes = find_routes(
-            route=shortest_route, visited_locations=visited_locations)
-        # Filtering out routes by distance to the same location
-        filter_and_merge_routes(
-            routes_to_explore=routes_to_explore, new_routes=new_routes)
-    return None
+
+def find_shortest_complete_route(
+        routes: list[Route], waste_amounts: list[int],
+        complete_route: Route | None
+        ) -> Route | None:
+    for route in routes:
+        if (complete_route is None
+                or route.distance < complete_route.distance) and (
+                is_complete_route(route=route, waste_amounts=waste_amounts)):
+            complete_route = route
+    return complete_route
 
 
-def filter_and_merge_routes(
-        routes_to_explore: set[Route], new_routes: set[Route]):
-    for new_route in list(new_routes):
-        for route_to_explore in list(routes_to_explore):
-            if new_route.next_location == route_to_explore.next_location:
-                if route_to_explore > new_route:
-                    routes_to_explore.discard(route_to_explore)
-                elif new_route > route_to_explore:
-                    new_routes.discard(new_route)
-    routes_to_explore.update(new_routes)
+def merge_routes(
+        best_routes: dict[int, Route], new_routes: list[Route],
+        route_queue: list[tuple[int, int, Route]]
+        ):
+    """ Keep only new routes, that are shorter than the best known route to
+    the same location. Replaced routes stay in the queue as stale entries
+    """
+    for new_route in new_routes:
+        best_route = best_routes.get(new_route.next_location)
+        if best_route is None or new_route.distance < best_route.distance:
+            best_routes[new_route.next_location] = new_route
+            heapq.heappush(
+                route_queue,
+                (new_route.distance, next(route_order), new_route)
+                )
+
+
+def pop_shortest_route(
+        best_routes: dict[int, Route],
+        route_queue: list[tuple[int, int, Route]]
+        ) -> Route | None:
+    """ Pop the shortest route from the binary heap. Routes replaced in
+    "best_routes" are deleted lazily: their entries are skipped here
+    """
+    while route_queue:
+        _, _, route = heapq.heappop(route_queue)
+        if best_routes.get(route.next_location) is route:
+            return route
+    return None
 
 
 def find_routes(
-        route: Route, visited_locations: list[Location],
+        route: Route, visited_locations: set[int], graph: RoadGraph,
+        capacity_index: CapacityIndex | None = None,
+        waste_ids: list[int] | None = None,
         partial_unload: bool | None = None
-        ) -> set[Route] | None:
-    """ Find new set of routes, that leads from "next_location" """
+        ) -> list[Route]:
+    """ Find new routes, that leads from "next_location" """
     location = route.next_location
-    routes = set()
-
-    roads = location.roads_from
-    for road in roads:
-        next_location = road.location_to
-        is_occupied_by_storage = next_location.storage_link is not None
-        # Travel only trough storages
-        if is_occupied_by_storage and next_location not in visited_locations:
-            storage = next_location.storage_link.storage
-            distance = route.distance + road.distance
-            route_history = route.route_history.copy()
-            route_history.append(storage)
+    routes = []
+
+    # Snapshot holds only roads to storages (travel only trough storages)
+    for next_location, road_distance in graph.roads_from(location):
+        if next_location not in visited_locations:
+            distance = route.distance + road_distance
             if route.space_counters is None:
                 new_route = Route(
-                    next_location=next_location, route_history=route_history,
-                    distance=distance
+                    next_location=next_location, distance=distance,
+                    previous_route=route
                     )
             else:
                 updated_space_counters = update_space_counters(
-                    space_counters=route.space_counters, storage=storage,
+                    space_counters=route.space_counters, waste_ids=waste_ids,
+                    storage_id=graph.storage_ids[next_location],
+                    capacity_index=capacity_index,
                     partial_unload=partial_unload
                     )
                 new_route = Route(
-                    next_location=next_location, route_history=route_history,
-                    distance=distance, space_counters=updated_space_counters
+                    next_location=next_location, distance=distance,
+                    previous_route=route,
+                    space_counters=updated_space_counters
                     )
-            routes.add(new_route)
+            routes.append(new_route)
     return routes
 
 
+def build_route_public(
+        session: Session, route: Route, graph: RoadGraph) -> RoutePublic:
+    """ Build storage list of the found route by following parent
+    pointers (storages are loaded with one query)
+    """
+    distance = route.distance
+    storage_ids = []
+    while route.previous_route is not None:
+        storage_ids.append(graph.storage_ids[route.next_location])
+        route = route.previous_route
+    storage_ids.reverse()
+    return build_route_from_storages(
+        session=session, storage_ids=storage_ids, distance=distance)
+
+
+def build_search_result(
+        session: Session, route: Route, graph: RoadGraph,
+        stats: SearchStats, start: float, approximate: bool = False
+        ) -> RoutePublic:
+    """ Build found route with search statistics """
+    stats.elapsed_ms = (time.perf_counter() - start) * 1000
+    route_public = build_route_public(
+        session=session, route=route, graph=graph)
+    route_public.approximate = approximate
+    route_public.stats = SearchStatsPublic(
+        expansions=stats.expansions, open_set_peak=stats.open_set_peak,
+        elapsed_ms=stats.elapsed_ms
+        )
+    return route_public
+
+
+def build_route_from_storages(
+        session: Session, storage_ids: list[int], distance: int
+        ) -> RoutePublic:
+    storages = load_storages(session=session, storage_ids=storage_ids)
+    route_history = [storages[storage_id] for storage_id in storage_ids]
+    return RoutePublic(route_history=route_history, distance=distance)
+
+
 def update_space_counters(
-        space_counters: list[SpaceCounter], storage: Storage,
-        partial_unload: bool
-        ):
+        space_counters: tuple[int, ...], waste_ids: list[int],
+        storage_id: int, capacity_index: CapacityIndex, partial_unload: bool
+        ) -> tuple[int, ...]:
     new_space_counters = []
-    for space_counter in space_counters:
-        company_waste_link = space_counter.company_waste_link
-        total_empty_space = space_counter.total_empty_space
-        company_waste_type = company_waste_link.waste
-        # Check if storage can recieve waste type and calculate
-        # available space
-        empty_storage_space = 0
-        for storage_waste_link in storage.waste_links:
-            storage_waste_type = storage_waste_link.waste
-            if company_waste_type == storage_waste_type:
-                empty_storage_space = (storage_waste_link.max_amount
-                                       - storage_waste_link.amount)
-                break
+    for total_empty_space, waste_id in zip(space_counters, waste_ids):
+        # Available space (0 if storage can not recieve waste type)
+        empty_storage_space = capacity_index.get((storage_id, waste_id), 0)
         # Increment counter only for partial unloading
         if partial_unload:
             total_empty_space += empty_storage_space
         else:
             total_empty_space = empty_storage_space
-        new_space_counter = SpaceCounter(
-            company_waste_link=space_counter.company_waste_link,
-            total_empty_space=total_empty_space
-            )
-        new_space_counters.append(new_space_counter)
-    return new_space_counters
+        new_space_counters.append(total_empty_space)
+    return tuple(new_space_counters)
 
 
-def unload_company(session: Session, route: Route, company: Company):
-    storage = route.route_history[-1]
-    for company_waste_link in company.waste_links:
-        waste = company_waste_link.waste
-        waste_amount = company_waste_link.amount
-        storage_waste_link = crud.get_db_link(
-            session=session, db_table=StorageWasteLink,
-            id_field_1="storage_id", value_1=storage.id,
-            id_field_2="waste_id", value_2=waste.id
-            )
-        if storage_waste_link:
-            crud.update_db_object(
-                session=session, db_object=storage_waste_link,
-                update_data={"amount": (storage_waste_link.amount
-                                        + waste_amount)}
-                )
-            crud.update_db_object(
-                session=session, db_object=company_waste_link,
-                update_data={"amount": 0}
-                )
+def unload_company(session: Session, route: RoutePublic, company: Company):
+    """ Transfer all waste types to the last storage in one transaction """
+    storage_id = route.route_history[-1].id
+    company_amounts, storage_free_amounts = load_waste_amounts(
+        session=session, company_id=company.id, storage_ids=[storage_id])
+    transfers = {
+        (storage_id, waste_id): amount
+        for waste_id, amount in company_amounts.items()
+        if amount > 0 and (storage_id, waste_id) in storage_free_amounts
+        }
+    transfer_waste(
+        session=session, company_id=company.id, transfers=transfers,
+        distances={storage_id: route.distance for storage_id, _ in transfers}
+        )
 
 
 def partially_unload_company(
-        session: Session, route: Route, company: Company,
-        company_waste_link: CompanyWasteLink
+        session: Session, route: RoutePublic, company: Company,
+        company_waste_links: list[CompanyWasteLink]
         ):
-    waste = company_waste_link.waste
-    waste_amount = company_waste_link.amount
-    for storage in route.route_history:
-        storage_waste_link = crud.get_db_link(
-            session=session, db_table=StorageWasteLink,
-            id_field_1="storage_id", value_1=storage.id,
-            id_field_2="waste_id", value_2=waste.id
+    """ Transfer waste types to storages along the route, filling storages
+    in route order, in one transaction
+    """
+    # Route may pass a storage several times
+    storage_ids = list(dict.fromkeys(
+        storage.id for storage in route.route_history))
+    company_amounts, storage_free_amounts = load_waste_amounts(
+        session=session, company_id=company.id, storage_ids=storage_ids,
+        waste_ids=[waste_link.waste_id for waste_link in company_waste_links]
+        )
+    transfers = {}
+    for waste_id, waste_amount in company_amounts.items():
+        for storage_id in storage_ids:
+            if waste_amount == 0:
+                break
+            amount = min(waste_amount, storage_free_amounts.get(
+                (storage_id, waste_id), 0))
+            if amount <= 0:
+                continue
+            transfers[(storage_id, waste_id)] = amount
+            waste_amount -= amount
+        # Storages were filled after the route was found
+        if waste_amount > 0:
+            raise UnloadConflict
+    transfer_waste(
+        session=session, company_id=company.id, transfers=transfers,
+        distances={storage_id: route.distance for storage_id, _ in transfers}
+        )
+
+
+def load_waste_amounts(
+        session: Session, company_id: int, storage_ids: list[int],
+        waste_ids: list[int] | None = None
+        ) -> tuple[dict[int, int], dict[tuple[int, int], int]]:
+    """ Current company waste amounts and free space of storages,
+    optionally only for specified waste types. Used only to plan transfer
+    amounts, transfer_waste() checks them again
+    """
+    statement = (
+        select(CompanyWasteLink.waste_id, CompanyWasteLink.amount)
+        .where(CompanyWasteLink.company_id == company_id)
+        )
+    if waste_ids is not None:
+        statement = statement.where(CompanyWasteLink.waste_id.in_(waste_ids))
+    company_amounts = dict(session.exec(statement).all())
+    statement = (
+        select(StorageWasteLink.storage_id, StorageWasteLink.waste_id,
+               StorageWasteLink.max_amount - StorageWasteLink.amount)
+        .where(StorageWasteLink.storage_id.in_(storage_ids))
+        .where(StorageWasteLink.waste_id.in_(list(company_amounts)))
+        )
+    storage_free_amounts = {
+        (storage_id, waste_id): free_amount
+        for storage_id, waste_id, free_amount in session.exec(statement)
+        }
+    return company_amounts, storage_free_amounts
+
+
+def transfer_waste(
+        session: Session, company_id: int,
+        transfers: dict[tuple[int, int], int], distances: dict[int, int]
+        ):
+    """ Move waste amounts ((storage id, waste id) -> amount) from company
+    to storages in one transaction. Every amount is changed by one atomic
+    UPDATE, that checks company amount and storage capacity in the
+    database, so concurrent transfers can not overfill storages. Rows are
+    updated in primary key order, company links first, so concurrent
+    transfers can not deadlock. Transfers are recorded in the ledger with
+    distances to storages (storage id -> distance)
+    """
+    waste_amounts = defaultdict(int)
+    for (storage_id, waste_id), amount in transfers.items():
+        waste_amounts[waste_id] += amount
+    for waste_id in sorted(waste_amounts):
+        company_amount = crud.increment_db_field(
+            session=session, db_table=CompanyWasteLink,
+            filters={"company_id": company_id, "waste_id": waste_id},
+            field="amount", delta=-waste_amounts[waste_id]
             )
-        empty_storage_space = (storage_waste_link.max_amount
-                               - storage_waste_link.amount)
-        if waste_amount > empty_storage_space:
-            update_data = {"amount": (storage_waste_link.max_amount)}
-        else:
-            update_data = {"amount": (storage_waste_link.amount+waste_amount)}
-        crud.update_db_object(
-            session=session, db_object=storage_waste_link,
-            update_data=update_data
+        # Company waste was unloaded by another request
+        if company_amount is None:
+            session.rollback()
+            raise UnloadConflict
+    for storage_id, waste_id in sorted(transfers):
+        storage_amount = crud.increment_db_field(
+            session=session, db_table=StorageWasteLink,
+            filters={"storage_id": storage_id, "waste_id": waste_id},
+            field="amount", delta=transfers[(storage_id, waste_id)],
+            max_field="max_amount"
             )
-        waste_amount -= empty_storage_space
-    crud.update_db_object(
-        session=session, db_object=company_waste_link,
-        update_data={"amount": 0}
+        # Storage was filled after the route was found
+        if storage_amount is None:
+            session.rollback()
+            raise UnloadConflict
+    record_transfers(
+        session=session, company_id=company_id, transfers=transfers,
+        distances=distances
         )
+    session.commit()
+    bump_capacity_version(session=session)
 
 
-def find_connected_storages(company: Company) -> list[Storage]:
-    company_location = company.location_link.location
-    storages = []
-    roads = deque(company_location.roads_from)
+def find_connected_storages(
+        session: Session, company: Company) -> list[Storage]:
+    graph = get_road_graph(session=session)
+    company_location = graph.company_nodes[company.id]
+    storage_ids = []
+    locations = deque([company_location])
     visited_locations = set()
-    while roads:
-        road = roads.popleft()
-        location = road.location_to
-        if location.storage_link and location not in visited_locations:
-            print("location", location)
-            roads.extend(location.roads_from)
-            visited_locations.add(location)
-            storages.append(location.storage_link.storage)
-    return storages
+    while locations:
+        location = locations.popleft()
+        for next_location, _ in graph.roads_from(location):
+            if next_location not in visited_locations:
+                locations.append(next_location)
+                visited_locations.add(next_location)
+                storage_ids.append(graph.storage_ids[next_location])
+    storages = load_storages(session=session, storage_ids=storage_ids)
+    return [storages[storage_id] for storage_id in storage_ids]
+
+
+def load_storages(
+        session: Session, storage_ids: list[int] | None = None,
+        with_waste_links: bool = False
+        ) -> dict[int, Storage]:
+    """ Bulk load storages, optionally with their waste links """
+    statement = select(Storage)
+    if storage_ids is not None:
+        statement = statement.where(Storage.id.in_(storage_ids))
+    if with_waste_links:
+        statement = statement.options(selectinload(Storage.waste_links))
+    return {storage.id: storage for storage in session.exec(statement)}
+
+
+def load_companies(
+        session: Session, company_ids: list[int],
+        with_waste_links: bool = False
+        ) -> dict[int, Company]:
+    """ Bulk load companies, optionally with their waste links """
+    statement = select(Company).where(Company.id.in_(company_ids))
+    if with_waste_links:
+        statement = statement.options(selectinload(Company.waste_links))
+    return {company.id: company for company in session.exec(statement)}
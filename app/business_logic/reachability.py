@@ -0,0 +1,142 @@
+from array import array
+
+from .road_graph import RoadGraph, NO_STORAGE
+from .capacity_index import CapacityIndex
+
+
+class ReachabilityIndex:
+    """ Reachability over the storage-only road network
+
+    Nodes are grouped into strongly connected components. Components of
+    the condensation DAG keep bitsets of storage nodes, that can be reached
+    from them, so reachability check is a single bit test
+    """
+
+    def __init__(self, components: array, reachable: list[int]):
+        # node -> component
+        self.components = components
+        # component -> bitset of reachable storage nodes
+        self.reachable = reachable
+
+    def reachable_storages(self, source: int) -> int:
+        """ Bitset of storage nodes reachable from source node """
+        reachable = self.reachable[self.components[source]]
+        # Storage can not be reached from itself by a route without loops
+        return reachable & ~(1 << source)
+
+    def is_reachable(self, source: int, target: int) -> bool:
+        return source != target and bool(
+            self.reachable[self.components[source]] >> target & 1)
+
+
+def get_reachability_index(graph: RoadGraph) -> ReachabilityIndex:
+    """ Reachability index, cached with the road network snapshot """
+    with graph.indexes_lock:
+        reachability_index = graph.indexes.get("reachability_index")
+        if reachability_index is None:
+            reachability_index = build_reachability_index(graph=graph)
+            graph.indexes["reachability_index"] = reachability_index
+    return reachability_index
+
+
+def build_reachability_index(graph: RoadGraph) -> ReachabilityIndex:
+    components, component_count = find_strong_components(graph=graph)
+    members = [[] for _ in range(component_count)]
+    for node, component in enumerate(components):
+        members[component].append(node)
+    # Components are numbered in reverse topological order, so components
+    # reachable from a component are processed before it
+    reachable = []
+    for component in range(component_count):
+        component_reachable = 0
+        for node in members[component]:
+            if graph.storage_ids[node] != NO_STORAGE:
+                component_reachable |= 1 << node
+            for next_node, _ in graph.roads_from(node):
+                next_component = components[next_node]
+                if next_component != component:
+                    component_reachable |= reachable[next_component]
+        reachable.append(component_reachable)
+    return ReachabilityIndex(components=components, reachable=reachable)
+
+
+def find_strong_components(graph: RoadGraph) -> tuple[array, int]:
+    """ Strongly connected components (iterative Tarjan's algorithm).
+    Components are numbered in reverse topological order
+    """
+    offsets, targets = graph.offsets, graph.targets
+    node_count = len(graph)
+    order = array("q", [-1]) * node_count
+    lowlink = array("q", bytes(8 * node_count))
+    components = array("q", [-1]) * node_count
+    on_stack = bytearray(node_count)
+    stack = []
+    counter = 0
+    component_count = 0
+    for root in range(node_count):
+        if order[root] != -1:
+            continue
+        order[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+        # (node, position of the next road to explore)
+        work = [(root, offsets[root])]
+        while work:
+            node, position = work[-1]
+            if position < offsets[node + 1]:
+                work[-1] = (node, position + 1)
+                next_node = targets[position]
+                if order[next_node] == -1:
+                    order[next_node] = lowlink[next_node] = counter
+                    counter += 1
+                    stack.append(next_node)
+                    on_stack[next_node] = 1
+                    work.append((next_node, offsets[next_node]))
+                elif on_stack[next_node]:
+                    lowlink[node] = min(lowlink[node], order[next_node])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == order[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = 0
+                    components[member] = component_count
+                    if member == node:
+                        break
+                component_count += 1
+    return components, component_count
+
+
+def build_free_space_bits(
+        graph: RoadGraph, capacity_index: CapacityIndex) -> dict[int, int]:
+    """ Bitsets of storage nodes with free space for every waste type
+    (waste id -> bitset), built with one pass over the capacity index
+    """
+    waste_bytes = {}
+    byte_count = (len(graph) + 7) // 8
+    for (storage_id, waste_id), free_space in capacity_index.items():
+        storage_node = graph.storage_nodes.get(storage_id)
+        if free_space <= 0 or storage_node is None:
+            continue
+        if waste_id not in waste_bytes:
+            waste_bytes[waste_id] = bytearray(byte_count)
+        waste_bytes[waste_id][storage_node >> 3] |= 1 << (storage_node & 7)
+    return {
+        waste_id: int.from_bytes(node_bytes, "little")
+        for waste_id, node_bytes in waste_bytes.items()
+        }
+
+
+def has_reachable_capacity(
+        reachability_index: ReachabilityIndex, source: int,
+        free_space_bits: dict[int, int], waste_id: int
+        ) -> bool:
+    """ Check if any storage, reachable from source, has free space for
+    waste type
+    """
+    reachable = reachability_index.reachable_storages(source=source)
+    return bool(reachable & free_space_bits.get(waste_id, 0))
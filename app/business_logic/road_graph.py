@@ -0,0 +1,194 @@
+from array import array
+from threading import Lock, RLock
+
+from sqlmodel import Session, select
+
+from ..models.road import Road
+from ..models.companylocationlink import CompanyLocationLink
+from ..models.storagelocationlink import StorageLocationLink
+from .cache_version import get_cache_version, bump_cache_version
+
+
+# Value of "storage_ids" for locations not occupied by a storage
+# (database ids start from 1)
+NO_STORAGE = 0
+
+
+class RoadGraph:
+    """ Compact in-memory snapshot of the road network
+
+    Occupied locations are numbered with dense indices (nodes). Roads are
+    stored as adjacency lists in CSR form: roads from node "i" lead to
+    "targets[offsets[i]:offsets[i + 1]]" with matching "distances".
+    Routes can pass only through storages, so only roads leading to
+    storage locations are kept
+    """
+
+    def __init__(
+            self, location_ids: array, storage_ids: array,
+            offsets: array, targets: array, distances: array,
+            company_nodes: dict[int, int]
+            ):
+        self.location_ids = location_ids
+        self.storage_ids = storage_ids
+        self.offsets = offsets
+        self.targets = targets
+        self.distances = distances
+        self.company_nodes = company_nodes
+        # Road network version, the snapshot was loaded at
+        self.version: int | None = None
+        self.location_nodes = {
+            location_id: node for node, location_id in enumerate(location_ids)}
+        self.storage_nodes = {
+            storage_id: node for node, storage_id in enumerate(storage_ids)
+            if storage_id != NO_STORAGE
+            }
+        # Derived indexes (distance tables, reachability, ...), built
+        # lazily and dropped together with the snapshot. Reentrant, as
+        # some indexes are built from others
+        self.indexes = {}
+        self.indexes_lock = RLock()
+
+    def __len__(self):
+        return len(self.location_ids)
+
+    def roads_from(self, node: int) -> zip:
+        """ Pairs (next node, distance) for roads leading from node """
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return zip(self.targets[start:end], self.distances[start:end])
+
+    def reverse_roads(self) -> tuple[array, array, array]:
+        """ Roads in reverse CSR form (offsets, sources, distances): roads
+        to node "i" lead from "sources[offsets[i]:offsets[i + 1]]".
+        Built on first use and cached with the snapshot
+        """
+        with self.indexes_lock:
+            reverse_roads = self.indexes.get("reverse_roads")
+            if reverse_roads is None:
+                reverse_roads = build_reverse_roads(graph=self)
+                self.indexes["reverse_roads"] = reverse_roads
+        return reverse_roads
+
+    def roads_to(self, node: int) -> zip:
+        """ Pairs (previous node, distance) for roads leading to node """
+        offsets, sources, distances = self.reverse_roads()
+        start, end = offsets[node], offsets[node + 1]
+        return zip(sources[start:end], distances[start:end])
+
+
+# Snapshot of the road network, None until loaded. Snapshot is cached by
+# every process, so it is checked against the road network version in
+# the database
+road_graph: RoadGraph | None = None
+road_graph_lock = Lock()
+
+
+def get_road_graph(session: Session) -> RoadGraph:
+    """ Cached road network snapshot, loaded again when version changes """
+    global road_graph
+    version = get_graph_version(session=session)
+    with road_graph_lock:
+        if (version is not None and road_graph is not None
+                and road_graph.version == version):
+            return road_graph
+    # Version is read before the snapshot, so snapshot loaded during
+    # a change is replaced after the version is incremented
+    graph = load_road_graph(session=session)
+    graph.version = version
+    with road_graph_lock:
+        if version is not None and (
+                road_graph is None or road_graph.version < version):
+            road_graph = graph
+    return graph
+
+
+def is_outdated_road_graph(graph: RoadGraph) -> bool:
+    """ Check if a newer snapshot was loaded """
+    with road_graph_lock:
+        return road_graph is not None and road_graph is not graph
+
+
+def get_graph_version(session: Session) -> int | None:
+    return get_cache_version(session=session, field="graph_version")
+
+
+def bump_graph_version(session: Session):
+    """ Must be called when road network changes """
+    bump_cache_version(session=session, field="graph_version")
+
+
+def load_road_graph(session: Session) -> RoadGraph:
+    """ Load road network snapshot with a few bulk queries """
+    storage_links = session.exec(
+        select(StorageLocationLink.location_id, StorageLocationLink.storage_id)
+        ).all()
+    company_links = session.exec(
+        select(CompanyLocationLink.location_id, CompanyLocationLink.company_id)
+        ).all()
+    roads = session.exec(
+        select(Road.location_from_id, Road.location_to_id, Road.distance)
+        .order_by(Road.location_from_id, Road.location_to_id)
+        ).all()
+
+    location_ids = array("q")
+    storage_ids = array("q")
+    location_nodes = {}
+    for location_id, storage_id in storage_links:
+        location_nodes[location_id] = len(location_ids)
+        location_ids.append(location_id)
+        storage_ids.append(storage_id)
+    company_nodes = {}
+    for location_id, company_id in company_links:
+        location_nodes[location_id] = len(location_ids)
+        company_nodes[company_id] = len(location_ids)
+        location_ids.append(location_id)
+        storage_ids.append(NO_STORAGE)
+
+    # Count roads per node, then fill CSR arrays
+    node_roads = []
+    degrees = array("q", bytes(8 * len(location_ids)))
+    for location_from_id, location_to_id, distance in roads:
+        node_from = location_nodes.get(location_from_id)
+        node_to = location_nodes.get(location_to_id)
+        if node_from is None or node_to is None:
+            continue
+        # Travel only trough storages
+        if storage_ids[node_to] == NO_STORAGE:
+            continue
+        node_roads.append((node_from, node_to, distance))
+        degrees[node_from] += 1
+    offsets = array("q", [0])
+    for degree in degrees:
+        offsets.append(offsets[-1] + degree)
+    positions = array("q", offsets[:-1])
+    targets = array("q", bytes(8 * len(node_roads)))
+    distances = array("q", bytes(8 * len(node_roads)))
+    for node_from, node_to, distance in node_roads:
+        position = positions[node_from]
+        targets[position] = node_to
+        distances[position] = distance
+        positions[node_from] += 1
+
+    return RoadGraph(
+        location_ids=location_ids, storage_ids=storage_ids, offsets=offsets,
+        targets=targets, distances=distances, company_nodes=company_nodes
+        )
+
+
+def build_reverse_roads(graph: RoadGraph) -> tuple[array, array, array]:
+    degrees = array("q", bytes(8 * len(graph)))
+    for node_to in graph.targets:
+        degrees[node_to] += 1
+    offsets = array("q", [0])
+    for degree in degrees:
+        offsets.append(offsets[-1] + degree)
+    positions = array("q", offsets[:-1])
+    sources = array("q", bytes(8 * len(graph.targets)))
+    distances = array("q", bytes(8 * len(graph.targets)))
+    for node_from in range(len(graph)):
+        for node_to, distance in graph.roads_from(node_from):
+            position = positions[node_to]
+            sources[position] = node_from
+            distances[position] = distance
+            positions[node_to] += 1
+    return offsets, sources, distances
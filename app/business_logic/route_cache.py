@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from threading import Lock
+
+from sqlmodel import Session
+
+from ..models.company import Company
+from ..models.companywastelink import CompanyWasteLink
+from ..models.route import RoutePublic
+from .capacity_index import get_capacity_version
+from .optimal_route import (
+    SearchBudget, find_optimal_unload_route, build_route_from_storages)
+from .multi_waste_route import find_multi_waste_unload_route
+from .road_graph import get_graph_version
+
+
+# Max number of cached routes
+ROUTE_CACHE_MAX_SIZE = 4096
+
+# (company id, waste set, partial unload, graph version, capacity version)
+# -> (storage ids, distance) or None, least recently used first. Versions
+# are read from the database, so routes cached by every process stay
+# valid
+route_cache: OrderedDict[tuple, tuple[list[int], int] | None] = OrderedDict()
+route_cache_lock = Lock()
+
+
+def get_optimal_unload_route(
+        session: Session, company: Company,
+        company_waste_links: list[CompanyWasteLink], partial_unload: bool,
+        budget: SearchBudget | None = None
+        ) -> RoutePublic | None:
+    """ Cached find_optimal_unload_route() (or multi waste search for
+    partial unloading of several waste types). Results stay valid until
+    road network, storage capacities or company waste amounts change.
+    Approximate results are not cached
+    """
+    # Versions are read before the search, so results computed during
+    # a change are cached under outdated versions and never used
+    waste_set = tuple(sorted(
+        (waste_link.waste_id, waste_link.amount)
+        for waste_link in company_waste_links
+        ))
+    graph_version = get_graph_version(session=session)
+    capacity_version = get_capacity_version(session=session)
+    key = None
+    if graph_version is not None and capacity_version is not None:
+        key = (company.id, waste_set, partial_unload, graph_version,
+               capacity_version)
+    with route_cache_lock:
+        cached = key in route_cache
+        if cached:
+            route_cache.move_to_end(key)
+            cached_route = route_cache[key]
+    if cached:
+        if cached_route is None:
+            return None
+        storage_ids, distance = cached_route
+        # Storages are loaded again, so their data is always fresh
+        return build_route_from_storages(
+            session=session, storage_ids=storage_ids, distance=distance)
+    if partial_unload and len(company_waste_links) > 1:
+        route = find_multi_waste_unload_route(
+            session=session, company=company,
+            company_waste_links=company_waste_links, budget=budget
+            )
+    else:
+        route = find_optimal_unload_route(
+            session=session, company=company,
+            company_waste_links=company_waste_links,
+            partial_unload=partial_unload, budget=budget
+            )
+    if key is None or route is not None and route.approximate:
+        return route
+    if route is None:
+        cached_route = None
+    else:
+        storage_ids = [storage.id for storage in route.route_history]
+        cached_route = (storage_ids, route.distance)
+    with route_cache_lock:
+        route_cache[key] = cached_route
+        if len(route_cache) > ROUTE_CACHE_MAX_SIZE:
+            route_cache.popitem(last=False)
+    return route
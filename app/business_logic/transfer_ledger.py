@@ -0,0 +1,172 @@
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from sqlalchemy import func, text
+from sqlmodel import Session, select
+
+from ..models.wastetransfer import (
+    WasteTransfer, WasteTransferSnapshot, WasteTransferTotal,
+    WasteTransferTotalPublic, utc_now
+    )
+from .. import crud
+
+
+# (company id, storage id, waste id) -> amount
+TransferTotals = dict[tuple[int, int, int], int]
+
+
+def record_transfers(
+        session: Session, company_id: int,
+        transfers: dict[tuple[int, int], int], distances: dict[int, int]
+        ):
+    """ Add ledger rows for waste transfers ((storage id, waste id) ->
+    amount) to the current transaction, without commit
+    """
+    created_at = utc_now()
+    session.add_all([
+        WasteTransfer(
+            company_id=company_id, storage_id=storage_id, waste_id=waste_id,
+            amount=amount, distance=distances[storage_id],
+            created_at=created_at
+            )
+        for (storage_id, waste_id), amount in sorted(transfers.items())
+        ])
+
+
+def get_transfers(
+        session: Session, skip: int, limit: int,
+        company_id: int | None = None, storage_id: int | None = None,
+        waste_id: int | None = None
+        ) -> list[WasteTransfer]:
+    statement = select(WasteTransfer)
+    if company_id is not None:
+        statement = statement.where(WasteTransfer.company_id == company_id)
+    if storage_id is not None:
+        statement = statement.where(WasteTransfer.storage_id == storage_id)
+    if waste_id is not None:
+        statement = statement.where(WasteTransfer.waste_id == waste_id)
+    return session.exec(
+        statement.order_by(WasteTransfer.id).offset(skip).limit(limit)).all()
+
+
+def create_transfer_snapshot(session: Session) -> WasteTransferSnapshot:
+    """ Store total amounts transferred so far. Only transfers recorded
+    after the previous snapshot are read from the ledger
+    """
+    lock_transfer_ledger(session=session)
+    previous_snapshot = get_last_snapshot(session=session)
+    db_snapshot = WasteTransferSnapshot()
+    session.add(db_snapshot)
+    # Snapshot id for totals. SQLite allows one writing transaction, so
+    # writing also waits for transactions, that record transfers
+    session.flush()
+    db_snapshot.last_transfer_id = session.exec(
+        select(func.max(WasteTransfer.id))).one() or 0
+    # Covered transfers were recorded before this time
+    db_snapshot.created_at = utc_now()
+    totals = get_transfer_totals(
+        session=session, snapshot=previous_snapshot,
+        last_transfer_id=db_snapshot.last_transfer_id
+        )
+    crud.bulk_create_db_objects(
+        session=session, db_table=WasteTransferTotal,
+        rows=[
+            {"snapshot_id": db_snapshot.id, "company_id": company_id,
+             "storage_id": storage_id, "waste_id": waste_id,
+             "amount": amount}
+            for (company_id, storage_id, waste_id), amount in totals.items()
+            ]
+        )
+    return db_snapshot
+
+
+def lock_transfer_ledger(session: Session):
+    """ Wait until transactions, that record transfers, commit and block
+    new ones until the end of the current transaction. Otherwise transfer
+    with id lower than the last committed one could commit after the
+    snapshot and would never be counted
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        session.exec(text(
+            f"LOCK TABLE {WasteTransfer.__tablename__} "
+            "IN SHARE ROW EXCLUSIVE MODE"
+            ))
+
+
+def get_period_totals(
+        session: Session, start: datetime | None = None,
+        end: datetime | None = None
+        ) -> list[WasteTransferTotalPublic]:
+    """ Amounts transferred after start and up to end (since the first
+    transfer and up to now by default)
+    """
+    end_totals = get_totals_at(session=session, time=end)
+    start_totals = {}
+    if start is not None:
+        start_totals = get_totals_at(session=session, time=start)
+    output = []
+    for (company_id, storage_id, waste_id), amount in sorted(
+            end_totals.items()):
+        amount -= start_totals.get((company_id, storage_id, waste_id), 0)
+        if amount > 0:
+            output.append(WasteTransferTotalPublic(
+                company_id=company_id, storage_id=storage_id,
+                waste_id=waste_id, amount=amount
+                ))
+    return output
+
+
+def get_totals_at(
+        session: Session, time: datetime | None = None) -> TransferTotals:
+    """ Total amounts transferred up to time: the last snapshot taken
+    before it plus transfers recorded after the snapshot
+    """
+    if time is not None:
+        # Naive time is UTC
+        if time.tzinfo is None:
+            time = time.replace(tzinfo=timezone.utc)
+        time = time.astimezone(timezone.utc)
+    snapshot = get_last_snapshot(session=session, time=time)
+    return get_transfer_totals(session=session, snapshot=snapshot, time=time)
+
+
+def get_last_snapshot(
+        session: Session, time: datetime | None = None
+        ) -> WasteTransferSnapshot | None:
+    statement = select(WasteTransferSnapshot)
+    if time is not None:
+        statement = statement.where(WasteTransferSnapshot.created_at <= time)
+    return session.exec(
+        statement.order_by(WasteTransferSnapshot.id.desc())).first()
+
+
+def get_transfer_totals(
+        session: Session, snapshot: WasteTransferSnapshot | None,
+        time: datetime | None = None, last_transfer_id: int | None = None
+        ) -> TransferTotals:
+    """ Snapshot totals plus transfers recorded after the snapshot,
+    optionally only up to time or transfer id
+    """
+    totals = defaultdict(int)
+    first_transfer_id = 0
+    if snapshot is not None:
+        for total in session.exec(
+                select(WasteTransferTotal)
+                .where(WasteTransferTotal.snapshot_id == snapshot.id)):
+            totals[(total.company_id, total.storage_id, total.waste_id)] \
+                = total.amount
+        first_transfer_id = snapshot.last_transfer_id
+    statement = (
+        select(WasteTransfer.company_id, WasteTransfer.storage_id,
+               WasteTransfer.waste_id, func.sum(WasteTransfer.amount))
+        .where(WasteTransfer.id > first_transfer_id)
+        .group_by(WasteTransfer.company_id, WasteTransfer.storage_id,
+                  WasteTransfer.waste_id)
+        )
+    if time is not None:
+        statement = statement.where(WasteTransfer.created_at <= time)
+    if last_transfer_id is not None:
+        statement = statement.where(WasteTransfer.id <= last_transfer_id)
+    for company_id, storage_id, waste_id, amount in session.exec(statement):
+        totals[(company_id, storage_id, waste_id)] += amount
+    return totals
@@ -0,0 +1,77 @@
+from sqlmodel import Session
+
+from ..models.company import Company
+from ..models.companywastelink import CompanyWasteLink
+from ..models.route import StorageAllocation, WasteAllocationPublic
+from .capacity_index import load_capacity_index
+from .distance_table import get_distance_table
+from .optimal_route import load_storages, transfer_waste
+
+
+def find_optimal_allocation(
+        session: Session, company: Company,
+        company_waste_link: CompanyWasteLink
+        ) -> WasteAllocationPublic | None:
+    """ Split waste amount between reachable storages with minimal total
+    amount * distance (None if reachable storages have not enough space)
+
+    Min-cost flow from company to storages, where storages are sinks with
+    capacity of their free space. Roads have no capacity, so every unit
+    travels by the shortest route and the optimal flow fills storages in
+    order of distance, starting from the nearest one
+    """
+    waste_id = company_waste_link.waste_id
+    waste_amount = company_waste_link.amount
+    distance_table = get_distance_table(session=session, company=company)
+    capacity_index = load_capacity_index(
+        session=session, waste_ids=[waste_id])
+    storages = sorted(
+        (storage_distance.distance, storage_id)
+        for storage_id, storage_distance in distance_table.items()
+        if capacity_index.get((storage_id, waste_id), 0) > 0
+        )
+    allocations = []
+    for distance, storage_id in storages:
+        if waste_amount == 0:
+            break
+        amount = min(waste_amount, capacity_index[(storage_id, waste_id)])
+        allocations.append((storage_id, amount, distance))
+        waste_amount -= amount
+    if waste_amount > 0:
+        return None
+    db_storages = load_storages(
+        session=session,
+        storage_ids=[storage_id for storage_id, _, _ in allocations]
+        )
+    return WasteAllocationPublic(
+        allocations=[
+            StorageAllocation(
+                storage=db_storages[storage_id], amount=amount,
+                distance=distance
+                )
+            for storage_id, amount, distance in allocations
+            ],
+        cost=sum(amount * distance for _, amount, distance in allocations)
+        )
+
+
+def allocate_company_waste(
+        session: Session, allocation: WasteAllocationPublic,
+        company_waste_link: CompanyWasteLink
+        ):
+    """ Transfer waste to storages according to allocation in one
+    transaction
+    """
+    waste_id = company_waste_link.waste_id
+    transfers = {
+        (storage_allocation.storage.id, waste_id): storage_allocation.amount
+        for storage_allocation in allocation.allocations
+        }
+    transfer_waste(
+        session=session, company_id=company_waste_link.company_id,
+        transfers=transfers,
+        distances={
+            storage_allocation.storage.id: storage_allocation.distance
+            for storage_allocation in allocation.allocations
+            }
+        )
@@ -27,6 +27,15 @@ class Settings(BaseSettings):
     fake_db_user: str
     fake_db_password: str
 
+    # Routing settings
+    # Answer company -> storage distance queries with contraction
+    # hierarchy (built in background after road network changes)
+    contraction_hierarchy: bool = False
+    # Unload route search limits, after them the best route found so far
+    # is returned as approximate (unset for no limit)
+    route_max_expansions: int | None = 1000000
+    route_time_limit_ms: float | None = 5000
+
     # Load from .env
     model_config = SettingsConfigDict(env_file=".env")
 
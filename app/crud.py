@@ -1,6 +1,11 @@
+from sqlalchemy import insert, update
 from sqlmodel import Session, SQLModel, select
 
 
+# Attempts of update of versioned object, changed by concurrent requests
+UPDATE_ATTEMPTS = 3
+
+
 def create_db_object(session: Session, db_object: SQLModel):
     session.add(db_object)
     session.commit()
@@ -8,6 +13,20 @@ def create_db_object(session: Session, db_object: SQLModel):
     return db_object
 
 
+def bulk_create_db_objects(
+        session: Session, db_table: type[SQLModel], rows: list[dict]):
+    """ Insert many rows with one INSERT ... RETURNING statement and one
+    commit
+    """
+    db_objects = []
+    if rows:
+        db_objects = session.exec(
+            insert(db_table).returning(db_table), params=rows
+            ).scalars().all()
+    session.commit()
+    return db_objects
+
+
 def get_db_objects(
         session: Session, db_class: type[SQLModel], skip: int, limit: int):
     db_objects = session.exec(select(db_class).offset(skip).limit(limit)).all()
@@ -29,6 +48,45 @@ def update_db_object(session: Session, db_object: SQLModel, update_data: dict):
     return db_object
 
 
+def bulk_update_db_objects(
+        session: Session, db_table: type[SQLModel], rows: list[dict]):
+    """ Update many rows by primary key (every row contains primary key
+    fields) with one executemany UPDATE statement and one commit. Rows of
+    versioned tables contain the current version, StaleDataError is raised
+    if any of them was changed by a concurrent request
+    """
+    if rows:
+        session.exec(update(db_table), params=rows)
+    session.commit()
+
+
+def increment_db_field(
+        session: Session, db_table: type[SQLModel], filters: dict,
+        field: str, delta: int, max_field: str | None = None
+        ) -> int | None:
+    """ Add delta to field with one UPDATE ... RETURNING statement, only
+    if the result stays between 0 and max_field value. Returns new value
+    or None, if no row was updated. Does not commit, so several increments
+    can form one transaction
+    """
+    column = getattr(db_table, field)
+    statement = update(db_table).where(column + delta >= 0)
+    for filter_field, value in filters.items():
+        statement = statement.where(getattr(db_table, filter_field) == value)
+    if max_field is not None:
+        statement = statement.where(
+            column + delta <= getattr(db_table, max_field))
+    values = {field: column + delta}
+    # Concurrent compare-and-swap updates of the row must fail
+    version_column = db_table.__mapper__.version_id_col
+    if version_column is not None:
+        values[version_column.key] = version_column + 1
+    return session.exec(
+        statement.values(values).returning(column)
+        .execution_options(synchronize_session=False)
+        ).scalar_one_or_none()
+
+
 def delete_db_object(session: Session, db_object: SQLModel):
     session.delete(db_object)
     session.commit()
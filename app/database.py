@@ -1,5 +1,9 @@
+from sqlalchemy import inspect, text
 from sqlmodel import SQLModel, create_engine, Session, select
 from .models.admin import Admin
+from .models.companywastelink import CompanyWasteLink
+from .models.storagewastelink import StorageWasteLink
+from .business_logic.cache_version import create_cache_version
 from .security import hash_password
 from .config import get_settings
 
@@ -20,7 +24,25 @@ def get_session():
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    add_version_columns(engine)
     create_admin(engine)
+    create_cache_version(engine)
+
+
+def add_version_columns(engine):
+    # create_all() does not change existing tables, so row versions of
+    # waste links are added to databases created before them
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for db_table in [CompanyWasteLink, StorageWasteLink]:
+            table_name = db_table.__tablename__
+            columns = [
+                column["name"] for column in inspector.get_columns(table_name)]
+            if "version" not in columns:
+                connection.execute(text(
+                    f"ALTER TABLE {table_name} "
+                    "ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+                    ))
 
 
 def create_admin(engine):
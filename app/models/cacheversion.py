@@ -0,0 +1,11 @@
+from sqlalchemy import BigInteger
+from sqlmodel import Field, SQLModel
+
+
+# Versions of data, that application processes cache (road network
+# snapshot, routes). Single row, versions are incremented after every
+# change, so every process notices changes made by others
+class CacheVersion(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    graph_version: int = Field(default=0, sa_type=BigInteger)
+    capacity_version: int = Field(default=0, sa_type=BigInteger)
@@ -45,3 +45,10 @@ class CompanyUpdate(SQLModel):
     name: str | None = None
     email: EmailStr | None = None
     password: str | None = None
+
+
+class CompanyPublicStorage(CompanyBase):
+    id: int
+    # Distance from company to storage
+    distance: int
+    waste_links: list["CompanyWasteLinkPublic"]
@@ -1,5 +1,6 @@
 from typing import TYPE_CHECKING
 
+from sqlalchemy.orm import declared_attr
 from sqlmodel import Field, Relationship, SQLModel
 
 if TYPE_CHECKING:
@@ -17,10 +18,17 @@ class CompanyWasteLink(CompanyWasteLinkBase, table=True):
     company_id: int | None = Field(
         default=None, foreign_key="company.id", primary_key=True)
     amount: int = Field(default=0, ge=0)
+    # Incremented on every update, updates of outdated rows are rejected
+    version: int = Field(default=1)
     # Relationships
     company: "Company" = Relationship(back_populates="waste_links")
     waste: "Waste" = Relationship(back_populates="company_links")
 
+    @declared_attr
+    def __mapper_args__(cls):
+        # Compare-and-swap updates (UPDATE ... WHERE version = ?)
+        return {"version_id_col": cls.__table__.c.version}
+
 
 class CompanyWasteLinkPublic(CompanyWasteLinkBase):
     amount: int
@@ -1,8 +1,6 @@
 from sqlmodel import SQLModel
 
-from .storage import Storage, StoragePublic
-from .location import Location
-from .companywastelink import CompanyWasteLink
+from .storage import StoragePublic
 
 
 # class RouteBase(SQLModel):
@@ -30,29 +28,56 @@ from .companywastelink import CompanyWasteLink
 #     route_history: list["StoragePublic"]
 
 
-class SpaceCounter(SQLModel):
-    company_waste_link: CompanyWasteLink
-    total_empty_space: int
-
-
 class RouteBase(SQLModel):
-    route_history: list["Storage"]
     distance: int
 
 
-class Route(RouteBase):
-    next_location: "Location"
-    space_counters: list[SpaceCounter] | None = None
+class SearchStatsPublic(SQLModel):
+    expansions: int
+    # Max number of routes in the route queue
+    open_set_peak: int
+    elapsed_ms: float
+
+
+class RoutePublic(RouteBase):
+    route_history: list["StoragePublic"]
+    # Route found after search limits were exhausted, may be not optimal
+    approximate: bool = False
+    # None for cached routes
+    stats: SearchStatsPublic | None = None
 
-    def __lt__(self, other: "Route"):
-        return self.distance < other.distance
 
-    def __hash__(self):
-        return hash(self.next_location.id)
+class CompanyRoutePlan(SQLModel):
+    company_id: int
+    # None if company has nothing to unload or no route was found
+    route: RoutePublic | None
+    expansions: int
 
-    def __repr__(self):
-        return f"route: {self.route_history}\ndistance: {self.distance}"
 
+class FleetRoutePlan(SQLModel):
+    plans: list[CompanyRoutePlan]
+    runtime_ms: float
+    expansions: int
 
-class RoutePublic(RouteBase):
-    route_history: list["StoragePublic"]
+
+class StorageAllocation(SQLModel):
+    storage: StoragePublic
+    amount: int
+    distance: int
+
+
+class WasteAllocationPublic(SQLModel):
+    allocations: list[StorageAllocation]
+    # Sum of amount * distance over allocations
+    cost: int
+
+
+class WasteCoverage(SQLModel):
+    waste_id: int
+    amount: int
+    # Free space for the waste type in the last storage of the route
+    free_amount: int
+
+
+class RouteAlternativePublic(RoutePublic):
+    coverage: list[WasteCoverage]
@@ -3,7 +3,8 @@ from typing import Optional
 from sqlmodel import Field, Relationship, SQLModel, AutoString
 from pydantic import EmailStr
 
-from .storagewastelink import StorageWasteLink, StorageWasteLinkPublic
+from .storagewastelink import (
+    StorageWasteLink, StorageWasteLinkPublic, StorageWasteLinkPublicFree)
 from .storagelocationlink import (
     StorageLocationLink, StorageLocationLinkPublic)
 
@@ -51,3 +52,11 @@ class StoragePublicCompany(StorageBase):
     id: int
     distance: int | None = None
     waste_links: list["StorageWasteLinkPublic"]
+
+
+class StoragePublicReachable(StorageBase):
+    id: int
+    distance: int
+    # Number of storages along the route, including this one
+    route_length: int
+    waste_links: list["StorageWasteLinkPublicFree"]
@@ -1,5 +1,7 @@
 from typing import TYPE_CHECKING
 
+from pydantic import computed_field
+from sqlalchemy.orm import declared_attr
 from sqlmodel import Field, Relationship, SQLModel
 
 if TYPE_CHECKING:
@@ -17,15 +19,28 @@ class StorageWasteLink(StorageWasteLinkBase, table=True):
     storage_id: int | None = Field(
         default=None, foreign_key="storage.id", primary_key=True)
     amount: int = Field(default=0)
+    # Row version, same as in CompanyWasteLink
+    version: int = Field(default=1)
     # Relationships
     storage: "Storage" = Relationship(back_populates="waste_links")
     waste: "Waste" = Relationship(back_populates="storage_links")
 
+    @declared_attr
+    def __mapper_args__(cls):
+        return {"version_id_col": cls.__table__.c.version}
+
 
 class StorageWasteLinkPublic(StorageWasteLinkBase):
     amount: int
 
 
+class StorageWasteLinkPublicFree(StorageWasteLinkPublic):
+    @computed_field
+    @property
+    def free_amount(self) -> int:
+        return self.max_amount - self.amount
+
+
 class StorageWasteLinkCreate(StorageWasteLinkBase):
     pass
 
@@ -0,0 +1,62 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import DateTime
+from sqlmodel import Field, SQLModel
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# Ledger keeps history of deleted companies, storages and wastes, so their
+# ids are not foreign keys
+
+class WasteTransferBase(SQLModel):
+    company_id: int = Field(index=True)
+    storage_id: int = Field(index=True)
+    waste_id: int = Field(index=True)
+    amount: int
+    # Route distance (distance to the storage for allocations)
+    distance: int
+    created_at: datetime = Field(
+        default_factory=utc_now, sa_type=DateTime(timezone=True), index=True)
+
+
+class WasteTransfer(WasteTransferBase, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+
+
+class WasteTransferPublic(WasteTransferBase):
+    id: int
+
+
+class WasteTransferSnapshotBase(SQLModel):
+    created_at: datetime = Field(
+        default_factory=utc_now, sa_type=DateTime(timezone=True), index=True)
+    # Snapshot totals include transfers with id up to this one
+    last_transfer_id: int = Field(default=0)
+
+
+class WasteTransferSnapshot(WasteTransferSnapshotBase, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+
+
+class WasteTransferSnapshotPublic(WasteTransferSnapshotBase):
+    id: int
+
+
+class WasteTransferTotalBase(SQLModel):
+    company_id: int = Field(primary_key=True)
+    storage_id: int = Field(primary_key=True)
+    waste_id: int = Field(primary_key=True)
+    amount: int
+
+
+# Total amount transferred up to the snapshot
+class WasteTransferTotal(WasteTransferTotalBase, table=True):
+    snapshot_id: int = Field(
+        foreign_key="wastetransfersnapshot.id", primary_key=True, index=True)
+
+
+class WasteTransferTotalPublic(WasteTransferTotalBase):
+    pass
@@ -1,8 +1,20 @@
-from fastapi import APIRouter, Depends
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, Query
 from sqlmodel import Session
 
+from ..business_logic.fleet_planner import plan_fleet_unload
+from ..business_logic.optimal_route import SearchBudget
+from ..business_logic.transfer_ledger import (
+    get_transfers, create_transfer_snapshot, get_period_totals)
+from ..config import Settings, get_settings
 from ..database import get_session
 from ..models.admin import Admin, AdminPublic, AdminUpdate
+from ..models.route import FleetRoutePlan
+from ..models.wastetransfer import (
+    WasteTransferPublic, WasteTransferSnapshotPublic,
+    WasteTransferTotalPublic
+    )
 from .. import crud
 from ..security import hash_password
 from .login import Role, authorize, authenticate_user_by_token
@@ -26,3 +38,61 @@ def update_admin(
         update_data.update({"hashed_password": hashed_password})
     return crud.update_db_object(
         session=session, db_object=db_admin, update_data=update_data)
+
+
+@router.get("/unload-plan/", response_model=FleetRoutePlan)
+@authorize(roles=[Role.ADMIN])
+def get_unload_plan(
+        company_ids: list[int] | None = Query(default=None),
+        reserve_capacity: bool = False,
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session),
+        settings: Settings = Depends(get_settings)
+        ):
+    budget = SearchBudget(
+        max_expansions=settings.route_max_expansions,
+        time_limit_ms=settings.route_time_limit_ms
+        )
+    return plan_fleet_unload(
+        session=session, company_ids=company_ids,
+        reserve_capacity=reserve_capacity, budget=budget
+        )
+
+
+@router.get("/transfers/", response_model=list[WasteTransferPublic])
+@authorize(roles=[Role.ADMIN])
+def get_waste_transfers(
+        company_id: int | None = None,
+        storage_id: int | None = None,
+        waste_id: int | None = None,
+        skip: int = Query(default=0, ge=0),
+        limit: int = Query(default=10, le=100),
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session)
+        ):
+    return get_transfers(
+        session=session, skip=skip, limit=limit, company_id=company_id,
+        storage_id=storage_id, waste_id=waste_id
+        )
+
+
+@router.post("/transfers/snapshots/",
+             response_model=WasteTransferSnapshotPublic)
+@authorize(roles=[Role.ADMIN])
+def create_waste_transfer_snapshot(
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session)
+        ):
+    return create_transfer_snapshot(session=session)
+
+
+@router.get("/transfers/totals/",
+            response_model=list[WasteTransferTotalPublic])
+@authorize(roles=[Role.ADMIN])
+def get_waste_transfer_totals(
+        start: datetime | None = None,
+        end: datetime | None = None,
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session)
+        ):
+    return get_period_totals(session=session, start=start, end=end)
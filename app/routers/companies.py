@@ -1,27 +1,39 @@
 from functools import wraps
 
 from fastapi import APIRouter, Depends, Query, HTTPException, status
+from sqlalchemy.orm.exc import StaleDataError
 from sqlmodel import Session
 
 from .wastes import get_db_waste_by_id
 from .locations import create_roads
 from ..business_logic.optimal_route import (
-    find_optimal_unload_route, unload_company, partially_unload_company,
-    find_connected_storages, find_optimal_storage_route
+    SearchBudget, SearchLimitExceeded, UnloadConflict, unload_company,
+    partially_unload_company, find_connected_storages, load_storages
     )
+from ..business_logic.route_cache import get_optimal_unload_route
+from ..business_logic.alternative_routes import (
+    find_alternative_unload_routes)
+from ..business_logic.waste_allocation import (
+    find_optimal_allocation, allocate_company_waste)
+from ..business_logic.distance_table import (
+    get_storage_distance, get_distance_table, get_nearest_storages)
+from ..business_logic.road_graph import bump_graph_version
+from ..config import Settings, get_settings
 from ..database import get_session, get_fake_db_session
 from ..models.company import (
     Company, CompanyPublic, CompanyPublicDetailed, CompanyCreate,
     CompanyUpdate
     )
-from .. models.storage import StoragePublic, StoragePublicCompany
+from .. models.storage import (
+    StoragePublic, StoragePublicCompany, StoragePublicReachable)
 from ..models.companywastelink import (
     CompanyWasteLink, CompanyWasteLinkPublic, CompanyWasteLinkCreate,
     CompanyWasteLinkUpdate
     )
 from ..models.companylocationlink import CompanyLocationLink
 from ..models.location import Location, LocationCreate
-from ..models.route import RoutePublic
+from ..models.route import (
+    RoutePublic, RouteAlternativePublic, WasteAllocationPublic)
 from .. import crud
 from ..security import hash_password
 from .login import Role, authenticate_user_by_token
@@ -122,6 +134,7 @@ def delete_company(
         db_location = db_location_link.location
         crud.delete_db_object(session=session, db_object=db_location)
     crud.delete_db_object(session=session, db_object=db_company)
+    bump_graph_version(session=session)
     return {"ok": True}
 
 
@@ -164,23 +177,34 @@ def update_company_waste_link(
         ):
     # Company validation
     get_db_company_by_id(session=session, company_id=company_id)
-    db_waste_link = get_db_company_waste_link(
-        session=session, company_id=company_id, waste_id=waste_id)
     update_data = waste_link.model_dump(exclude_unset=True)
-    amount = update_data.get("amount", db_waste_link.amount)
-    max_amount = update_data.get("max_amount", db_waste_link.max_amount)
-    if amount < db_waste_link.amount:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Can not decrease amount without unloading"
-            )
-    if amount > max_amount:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Amount can not be bigger than max amount"
-            )
-    return crud.update_db_object(
-        session=session, db_object=db_waste_link, update_data=update_data)
+    # Link changed by another request is validated again
+    for _ in range(crud.UPDATE_ATTEMPTS):
+        db_waste_link = get_db_company_waste_link(
+            session=session, company_id=company_id, waste_id=waste_id)
+        amount = update_data.get("amount", db_waste_link.amount)
+        max_amount = update_data.get("max_amount", db_waste_link.max_amount)
+        if amount < db_waste_link.amount:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Can not decrease amount without unloading"
+                )
+        if amount > max_amount:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Amount can not be bigger than max amount"
+                )
+        try:
+            return crud.update_db_object(
+                session=session, db_object=db_waste_link,
+                update_data=update_data
+                )
+        except StaleDataError:
+            session.rollback()
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="Waste amount changed, try again"
+        )
 
 
 @router.delete("/{company_id}/waste-types/{waste_id}")
@@ -256,9 +280,10 @@ def assign_company_location(
             )
 @authorize(roles=[Role.ADMIN, Role.COMPANY])
 def get_optimal_route_for_all_waste_types(
-        company_id: int,
+        company_id: int, partial_unload: bool = False,
         current_user: str = Depends(authenticate_user_by_token),
-        session: Session = Depends(get_session)
+        session: Session = Depends(get_session),
+        settings: Settings = Depends(get_settings)
         ):
     db_company = get_db_company_by_id(session=session, company_id=company_id)
     if not db_company.location_link:
@@ -276,9 +301,10 @@ def get_optimal_route_for_all_waste_types(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="No waste to unload"
             )
-    route = find_optimal_unload_route(
-        company=db_company, company_waste_links=db_company.waste_links,
-        partial_unload=False
+    route = find_unload_route(
+        session=session, company=db_company,
+        company_waste_links=db_company.waste_links,
+        partial_unload=partial_unload, settings=settings
         )
     if not route:
         raise HTTPException(
@@ -286,10 +312,13 @@ def get_optimal_route_for_all_waste_types(
     return route
 
 
-@router.post("/{company_id}/waste-types/unload/", tags=["companies"])
+@router.get("/{company_id}/waste-types/optimal-routes/",
+            response_model=list[RouteAlternativePublic], tags=["companies"]
+            )
 @authorize(roles=[Role.ADMIN, Role.COMPANY])
-def unload_all_waste_types(
+def get_alternative_routes_for_all_waste_types(
         company_id: int,
+        k: int = Query(default=3, ge=1, le=20),
         current_user: str = Depends(authenticate_user_by_token),
         session: Session = Depends(get_session)
         ):
@@ -309,17 +338,66 @@ def unload_all_waste_types(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="No waste to unload"
             )
-    route = find_optimal_unload_route(
-        company=db_company, company_waste_links=db_company.waste_links,
-        partial_unload=False
+    routes = find_alternative_unload_routes(
+        session=session, company=db_company,
+        company_waste_links=db_company.waste_links, k=k
+        )
+    if not routes:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Route not found")
+    return routes
+
+
+@router.post("/{company_id}/waste-types/unload/", tags=["companies"])
+@authorize(roles=[Role.ADMIN, Role.COMPANY])
+def unload_all_waste_types(
+        company_id: int, partial_unload: bool = False,
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session),
+        settings: Settings = Depends(get_settings)
+        ):
+    db_company = get_db_company_by_id(session=session, company_id=company_id)
+    if not db_company.location_link:
+        raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Location is not assigned to the company"
+                )
+    if not db_company.waste_links:
+        raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="No waste type is assigned to the company"
+                )
+    if sum([waste_link.amount for waste_link in db_company.waste_links]) == 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No waste to unload"
+            )
+    route = find_unload_route(
+        session=session, company=db_company,
+        company_waste_links=db_company.waste_links,
+        partial_unload=partial_unload, settings=settings
         )
     if not route:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Route not found"
             )
-    # Transfer all waste types to the last storage
-    unload_company(session=session, route=route, company=db_company)
+    try:
+        if partial_unload:
+            # Fill storages along the route
+            partially_unload_company(
+                session=session, route=route, company=db_company,
+                company_waste_links=db_company.waste_links
+                )
+        else:
+            # Transfer all waste types to the last storage
+            unload_company(
+                session=session, route=route, company=db_company)
+    except UnloadConflict:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Storage space changed, try again"
+            )
     return {"ok": True}
 
 
@@ -330,7 +408,8 @@ def unload_all_waste_types(
 def get_optimal_route_for_waste_type(
         company_id: int, waste_id: int,
         current_user: str = Depends(authenticate_user_by_token),
-        session: Session = Depends(get_session)
+        session: Session = Depends(get_session),
+        settings: Settings = Depends(get_settings)
         ):
     db_company = get_db_company_by_id(session=session, company_id=company_id)
     if not db_company.location_link:
@@ -345,9 +424,10 @@ def get_optimal_route_for_waste_type(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="No waste to unload"
             )
-    route = find_optimal_unload_route(
-        company=db_company, company_waste_links=[db_waste_link],
-        partial_unload=True
+    route = find_unload_route(
+        session=session, company=db_company,
+        company_waste_links=[db_waste_link], partial_unload=True,
+        settings=settings
         )
     if not route:
         raise HTTPException(
@@ -355,13 +435,49 @@ def get_optimal_route_for_waste_type(
     return route
 
 
+@router.get("/{company_id}/waste-types/{waste_id}/optimal-allocation/",
+            response_model=WasteAllocationPublic, tags=["companies"]
+            )
+@authorize(roles=[Role.ADMIN, Role.COMPANY])
+def get_optimal_allocation_for_waste_type(
+        company_id: int, waste_id: int,
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session)
+        ):
+    db_company = get_db_company_by_id(session=session, company_id=company_id)
+    if not db_company.location_link:
+        raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Location is not assigned to the company"
+                )
+    db_waste_link = get_db_company_waste_link(
+        session=session, company_id=company_id, waste_id=waste_id)
+    if db_waste_link.amount == 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No waste to unload"
+            )
+    allocation = find_optimal_allocation(
+        session=session, company=db_company,
+        company_waste_link=db_waste_link
+        )
+    if not allocation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Not enough space in reachable storages"
+            )
+    return allocation
+
+
 @router.post("/{company_id}/waste-types/{waste_id}/unload/",
              tags=["companies"])
 @authorize(roles=[Role.ADMIN, Role.COMPANY])
 def unload_waste_type(
         company_id: int, waste_id: int,
+        solver: bool = False,
         current_user: str = Depends(authenticate_user_by_token),
-        session: Session = Depends(get_session)
+        session: Session = Depends(get_session),
+        settings: Settings = Depends(get_settings)
         ):
     db_company = get_db_company_by_id(session=session, company_id=company_id)
     if not db_company.location_link:
@@ -376,19 +492,49 @@ def unload_waste_type(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="No waste to unload"
             )
-    route = find_optimal_unload_route(
-        company=db_company, company_waste_links=[db_waste_link],
-        partial_unload=True
+    # Split waste between storages nearest first instead of filling
+    # storages along one route
+    if solver:
+        allocation = find_optimal_allocation(
+            session=session, company=db_company,
+            company_waste_link=db_waste_link
+            )
+        if not allocation:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Not enough space in reachable storages"
+                )
+        try:
+            allocate_company_waste(
+                session=session, allocation=allocation,
+                company_waste_link=db_waste_link
+                )
+        except UnloadConflict:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Storage space changed, try again"
+                )
+        return {"ok": True}
+    route = find_unload_route(
+        session=session, company=db_company,
+        company_waste_links=[db_waste_link], partial_unload=True,
+        settings=settings
         )
     if not route:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Route not found"
             )
-    partially_unload_company(
-        session=session, route=route, company=db_company,
-        company_waste_link=db_waste_link
-        )
+    try:
+        partially_unload_company(
+            session=session, route=route, company=db_company,
+            company_waste_links=[db_waste_link]
+            )
+    except UnloadConflict:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Storage space changed, try again"
+            )
     return {"ok": True}
 
 
@@ -407,17 +553,81 @@ def get_connected_storages(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Location is not assigned to the company"
                 )
-    storages = find_connected_storages(company=db_company)
+    storages = find_connected_storages(session=session, company=db_company)
     return storages
 
 
+@router.get("/{company_id}/storages/reachable/",
+            response_model=list[StoragePublicReachable],
+            tags=["companies"])
+@authorize(roles=[Role.ADMIN, Role.COMPANY])
+def get_reachable_storages(
+        company_id: int,
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session)
+        ):
+    db_company = get_db_company_by_id(session=session, company_id=company_id)
+    if not db_company.location_link:
+        raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Location is not assigned to the company"
+                )
+    # One search for all distances and one bulk query for capacities
+    distance_table = get_distance_table(session=session, company=db_company)
+    db_storages = load_storages(
+        session=session, storage_ids=list(distance_table),
+        with_waste_links=True
+        )
+    output = []
+    for storage_id, storage_distance in sorted(
+            distance_table.items(), key=lambda item: item[1]):
+        output.append(StoragePublicReachable.model_validate(
+            db_storages[storage_id], update=storage_distance._asdict()))
+    return output
+
+
+@router.get("/{company_id}/waste-types/{waste_id}/nearest-storages/",
+            response_model=list[StoragePublicReachable],
+            tags=["companies"])
+@authorize(roles=[Role.ADMIN, Role.COMPANY])
+def get_nearest_storages_for_waste_type(
+        company_id: int, waste_id: int,
+        k: int = Query(default=5, ge=1, le=100),
+        min_free_amount: int = Query(default=1, ge=1),
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session)
+        ):
+    db_company = get_db_company_by_id(session=session, company_id=company_id)
+    if not db_company.location_link:
+        raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Location is not assigned to the company"
+                )
+    # Waste validation
+    get_db_waste_by_id(session=session, waste_id=waste_id)
+    nearest_storages = get_nearest_storages(
+        session=session, company=db_company, waste_id=waste_id,
+        min_free_amount=min_free_amount, k=k
+        )
+    db_storages = load_storages(
+        session=session, storage_ids=list(nearest_storages),
+        with_waste_links=True
+        )
+    output = []
+    for storage_id, storage_distance in nearest_storages.items():
+        output.append(StoragePublicReachable.model_validate(
+            db_storages[storage_id], update=storage_distance._asdict()))
+    return output
+
+
 @router.get("/{company_id}/storages/{storage_id}",
             response_model=StoragePublicCompany, tags=["companies"])
 @authorize(roles=[Role.ADMIN, Role.COMPANY])
 def get_storage(
         company_id: int, storage_id: int,
         current_user: str = Depends(authenticate_user_by_token),
-        session: Session = Depends(get_session)
+        session: Session = Depends(get_session),
+        settings: Settings = Depends(get_settings)
         ):
     db_company = get_db_company_by_id(session=session, company_id=company_id)
     if not db_company.location_link:
@@ -431,14 +641,17 @@ def get_storage(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Location is not assigned to the storage"
                 )
-    route = find_optimal_storage_route(company=db_company, storage=db_storage)
-    if not route:
+    distance = get_storage_distance(
+        session=session, company=db_company, storage=db_storage,
+        use_contraction_hierarchy=settings.contraction_hierarchy
+        )
+    if distance is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Route not found"
             )
     output = StoragePublicCompany.model_validate(db_storage)
-    output.distance = route.distance
+    output.distance = distance
     return output
 
 
@@ -476,3 +689,25 @@ def get_db_company_waste_link(
             detail="Waste not assigned to the company"
             )
     return db_company_waste_link
+
+
+def find_unload_route(
+        session: Session, company: Company,
+        company_waste_links: list[CompanyWasteLink], partial_unload: bool,
+        settings: Settings
+        ) -> RoutePublic | None:
+    budget = SearchBudget(
+        max_expansions=settings.route_max_expansions,
+        time_limit_ms=settings.route_time_limit_ms
+        )
+    try:
+        return get_optimal_unload_route(
+            session=session, company=company,
+            company_waste_links=company_waste_links,
+            partial_unload=partial_unload, budget=budget
+            )
+    except SearchLimitExceeded:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Route search limit exceeded"
+            )
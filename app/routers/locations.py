@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends, Query, HTTPException, status
-from sqlmodel import Session
+from sqlmodel import Session, select
 
+from ..business_logic.road_graph import bump_graph_version
 from ..database import get_session, get_fake_db_session
 from ..models.location import Location, LocationPublic, LocationPublicWithRoad
 from ..models.road import Road
@@ -67,6 +68,7 @@ def delete_location(
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Location not found")
     crud.delete_db_object(session=session, db_object=db_location)
+    bump_graph_version(session=session)
     return {"ok": True}
 
 
@@ -78,25 +80,29 @@ def create_roads(
     roads_from = location_in_fake_db.roads_from
     roads_to = location_in_fake_db.roads_to
     # Add only roads to locations that exist in db (assigned to objects)
-    for road in roads_from:
-        db_connected_location = crud.get_db_object_by_field(
-            session=session, db_table=Location,
-            field="name", value=road.location_to.name
+    connected_names = (
+        [road.location_to.name for road in roads_from]
+        + [road.location_from.name for road in roads_to]
         )
-        if db_connected_location:
-            db_road = Road(location_from=db_location,
-                           location_to=db_connected_location,
-                           distance=road.distance
-                           )
-            crud.create_db_object(session=session, db_object=db_road)
+    db_connected_locations = {
+        db_connected_location.name: db_connected_location.id
+        for db_connected_location in session.exec(
+            select(Location).where(Location.name.in_(connected_names)))
+        }
+    roads = []
+    for road in roads_from:
+        location_to_id = db_connected_locations.get(road.location_to.name)
+        if location_to_id:
+            roads.append({"location_from_id": db_location.id,
+                          "location_to_id": location_to_id,
+                          "distance": road.distance})
     for road in roads_to:
-        db_connected_location = crud.get_db_object_by_field(
-            session=session, db_table=Location,
-            field="name", value=road.location_from.name
-        )
-        if db_connected_location:
-            db_road = Road(location_from=db_connected_location,
-                           location_to=db_location,
-                           distance=road.distance
-                           )
-            crud.create_db_object(session=session, db_object=db_road)
+        location_from_id = db_connected_locations.get(
+            road.location_from.name)
+        if location_from_id:
+            roads.append({"location_from_id": location_from_id,
+                          "location_to_id": db_location.id,
+                          "distance": road.distance})
+    crud.bulk_create_db_objects(session=session, db_table=Road, rows=roads)
+    # Road network changed
+    bump_graph_version(session=session)
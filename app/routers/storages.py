@@ -1,10 +1,15 @@
 from functools import wraps
 
 from fastapi import APIRouter, Depends, Query, HTTPException, status
+from sqlalchemy.orm.exc import StaleDataError
 from sqlmodel import Session
 
 from .wastes import get_db_waste_by_id
 from .locations import create_roads
+from ..business_logic.road_graph import bump_graph_version
+from ..business_logic.capacity_index import bump_capacity_version
+from ..business_logic.distance_table import get_company_distances
+from ..business_logic.optimal_route import load_companies
 from ..database import get_session, get_fake_db_session
 from ..models.storage import (
     Storage, StoragePublic, StoragePublicDetailed, StorageCreate,
@@ -15,6 +20,7 @@ from ..models.storagewastelink import (
     StorageWasteLinkUpdate
     )
 from ..models.storagelocationlink import StorageLocationLink
+from ..models.company import CompanyPublicStorage
 from ..models.location import Location, LocationCreate
 from .. import crud
 from ..security import hash_password
@@ -115,6 +121,8 @@ def delete_storage(
         db_location = db_location_link.location
         crud.delete_db_object(session=session, db_object=db_location)
     crud.delete_db_object(session=session, db_object=db_storage)
+    bump_graph_version(session=session)
+    bump_capacity_version(session=session)
     return {"ok": True}
 
 
@@ -144,6 +152,7 @@ def assign_storage_waste_type(
             )
     crud.create_db_object(
         session=session, db_object=db_waste_link)
+    bump_capacity_version(session=session)
     return db_storage
 
 
@@ -157,23 +166,37 @@ def update_storage_waste_link(
         ):
     # Storage validation
     get_db_storage_by_id(session=session, storage_id=storage_id)
-    db_waste_link = get_db_storage_waste_link(
-        session=session, storage_id=storage_id, waste_id=waste_id)
     update_data = waste_link.model_dump(exclude_unset=True)
-    amount = update_data.get("amount", db_waste_link.amount)
-    max_amount = update_data.get("max_amount", db_waste_link.max_amount)
-    if amount > db_waste_link.amount:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Can not increase amount without recieving from company"
-            )
-    if amount > max_amount:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Amount can not be bigger than max amount"
-            )
-    return crud.update_db_object(
-        session=session, db_object=db_waste_link, update_data=update_data)
+    # Link changed by another request is validated again
+    for _ in range(crud.UPDATE_ATTEMPTS):
+        db_waste_link = get_db_storage_waste_link(
+            session=session, storage_id=storage_id, waste_id=waste_id)
+        amount = update_data.get("amount", db_waste_link.amount)
+        max_amount = update_data.get("max_amount", db_waste_link.max_amount)
+        if amount > db_waste_link.amount:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Can not increase amount without recieving from company"
+                )
+        if amount > max_amount:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Amount can not be bigger than max amount"
+                )
+        try:
+            db_waste_link = crud.update_db_object(
+                session=session, db_object=db_waste_link,
+                update_data=update_data
+                )
+        except StaleDataError:
+            session.rollback()
+            continue
+        bump_capacity_version(session=session)
+        return db_waste_link
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="Waste amount changed, try again"
+        )
 
 
 @router.delete("/{storage_id}/waste-types/{waste_id}")
@@ -194,6 +217,7 @@ def delete_storage_waste_type(
             )
     crud.delete_db_object(
         session=session, db_object=db_waste_link)
+    bump_capacity_version(session=session)
     return {"ok": True}
 
 
@@ -244,6 +268,35 @@ def assign_storage_location(
     return db_storage
 
 
+@router.get("/{storage_id}/companies/",
+            response_model=list[CompanyPublicStorage], tags=["storages"])
+@authorize(roles=[Role.ADMIN, Role.STORAGE])
+def get_reaching_companies(
+        storage_id: int,
+        current_user: str = Depends(authenticate_user_by_token),
+        session: Session = Depends(get_session)
+        ):
+    db_storage = get_db_storage_by_id(session=session, storage_id=storage_id)
+    if not db_storage.location_link:
+        raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Location is not assigned to the storage"
+                )
+    # One reverse search instead of a search from every company
+    company_distances = get_company_distances(
+        session=session, storage=db_storage)
+    db_companies = load_companies(
+        session=session, company_ids=list(company_distances),
+        with_waste_links=True
+        )
+    output = []
+    for company_id, distance in sorted(
+            company_distances.items(), key=lambda item: (item[1], item[0])):
+        output.append(CompanyPublicStorage.model_validate(
+            db_companies[company_id], update={"distance": distance}))
+    return output
+
+
 # Helper functions
 
 def get_db_storage_by_id(session: Session, storage_id: int) -> Storage:
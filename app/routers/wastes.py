@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends, Query, HTTPException, status
 from sqlmodel import Session
 
+from ..business_logic.capacity_index import bump_capacity_version
 from ..database import get_session
 from ..models.waste import Waste, WasteCreate, WastePublic, WasteUpdate
 from .. import crud
@@ -89,6 +90,7 @@ def delete_waste(
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Waste not found")
     crud.delete_db_object(session=session, db_object=db_waste)
+    bump_capacity_version(session=session)
     return {"ok": True}
 
 
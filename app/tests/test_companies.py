@@ -1,11 +1,15 @@
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import event, inspect, text, update
 from sqlmodel import Session, SQLModel, create_engine
 from sqlmodel.pool import StaticPool
 
 from ..main import app
 from ..config import get_settings
-from ..database import get_session, create_admin, get_fake_db_session
+from ..database import (
+    get_session, create_admin, get_fake_db_session, add_version_columns)
+from ..models.companywastelink import CompanyWasteLink
+from ..models.storagewastelink import StorageWasteLink
 from ..models.location import Location
 from ..models.road import Road
 from .routes_test_data import generate_fake_db, generate_companies_and_storages
@@ -261,6 +265,116 @@ def test_update_company_waste_link(client, admin_auth_header):
     assert response.status_code == 400
 
 
+def test_update_company_waste_link_conflict(client, admin_auth_header):
+    # Create waste
+    response = client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    waste_id = response.json()["id"]
+    # Create company
+    response = client.post(
+        url="api/v1/companies/create/",
+        json={"name": "company", "email": "company@example.com",
+              "password": "company"},
+        headers=admin_auth_header
+        )
+    company_id = response.json()["id"]
+    # Assign waste to company
+    client.post(
+        url=f"api/v1/companies/{company_id}/waste-types/assign/",
+        json={"waste_id": waste_id, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url=f"api/v1/companies/{company_id}/waste-types/{waste_id}/",
+        json={"amount": 50},
+        headers=admin_auth_header
+        )
+
+    def unload(mapper, connection, target):
+        # Another request unloads the company before update is written
+        connection.execute(
+            update(CompanyWasteLink)
+            .where(CompanyWasteLink.company_id == target.company_id)
+            .where(CompanyWasteLink.waste_id == target.waste_id)
+            .values(amount=0, version=CompanyWasteLink.version + 1)
+            )
+
+    # Update is validated again with unloaded amount
+    event.listen(CompanyWasteLink, "before_update", unload, once=True)
+    response = client.patch(
+        url=f"api/v1/companies/{company_id}/waste-types/{waste_id}/",
+        json={"amount": 60},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    assert response.json()["amount"] == 60
+
+    def update_version(mapper, connection, target):
+        connection.execute(
+            update(CompanyWasteLink)
+            .where(CompanyWasteLink.company_id == target.company_id)
+            .where(CompanyWasteLink.waste_id == target.waste_id)
+            .values(version=CompanyWasteLink.version + 1)
+            )
+
+    # Link changes on every attempt
+    event.listen(CompanyWasteLink, "before_update", update_version)
+    try:
+        response = client.patch(
+            url=f"api/v1/companies/{company_id}/waste-types/{waste_id}/",
+            json={"amount": 70},
+            headers=admin_auth_header
+            )
+    finally:
+        event.remove(CompanyWasteLink, "before_update", update_version)
+    assert response.status_code == 409
+    response = client.get(
+        url=f"api/v1/companies/{company_id}", headers=admin_auth_header)
+    assert response.json()["waste_links"][0]["amount"] == 60
+
+
+def test_add_version_columns(session, client, admin_auth_header):
+    client.post(
+        url="api/v1/companies/create/",
+        json={"name": "company1", "email": "company1@example.com",
+              "password": "company1"},
+        headers=admin_auth_header
+        )
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/1/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    # Database created before waste links had versions
+    engine = session.get_bind()
+    session.close()
+    with engine.begin() as connection:
+        for db_table in [CompanyWasteLink, StorageWasteLink]:
+            connection.execute(text(
+                f"ALTER TABLE {db_table.__tablename__} DROP COLUMN version"))
+    add_version_columns(engine)
+    # Nothing to add anymore
+    add_version_columns(engine)
+    for db_table in [CompanyWasteLink, StorageWasteLink]:
+        assert "version" in [
+            column["name"] for column in
+            inspect(engine).get_columns(db_table.__tablename__)
+            ]
+    response = client.patch(
+        url="api/v1/companies/1/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    assert response.json()["amount"] == 10
+
+
 def test_unload(fake_db_session, client, admin_auth_header):
     generate_fake_db(session=fake_db_session)
     generate_companies_and_storages(
@@ -3,7 +3,8 @@ from random import randint
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy.orm.exc import StaleDataError
+from sqlmodel import Session, SQLModel, create_engine, select
 from sqlmodel.pool import StaticPool
 
 from ..main import app
@@ -12,6 +13,10 @@ from ..database import get_session, create_admin, get_fake_db_session
 from .. import crud
 from ..models.location import Location
 from ..models.road import Road
+from ..models.storage import Storage
+from ..models.storagewastelink import StorageWasteLink
+from ..models.waste import Waste
+from ..routers.locations import create_roads
 
 
 @pytest.fixture(name="session")
@@ -320,3 +325,114 @@ def test_assign_locations(session, fake_db_session, client, admin_auth_header):
         headers=admin_auth_header
         )
     assert response.status_code == 400
+
+
+def test_bulk_create_db_objects(session):
+    locations = crud.bulk_create_db_objects(
+        session=session, db_table=Location,
+        rows=[{"name": "A1"}, {"name": "B1"}, {"name": "C1"}]
+        )
+    # Returned objects have generated ids
+    assert [(location.id, location.name) for location in locations] == [
+        (1, "A1"), (2, "B1"), (3, "C1")]
+    roads = crud.bulk_create_db_objects(
+        session=session, db_table=Road,
+        rows=[
+            {"location_from_id": 1, "location_to_id": 2, "distance": 10},
+            {"location_from_id": 2, "location_to_id": 1, "distance": 20}
+            ]
+        )
+    assert [(road.location_from_id, road.location_to_id, road.distance)
+            for road in roads] == [(1, 2, 10), (2, 1, 20)]
+    # Rows are committed
+    session.rollback()
+    assert len(session.exec(select(Location)).all()) == 3
+    assert len(session.exec(select(Road)).all()) == 2
+    assert [road.location_to.name for road in locations[0].roads_from] \
+        == ["B1"]
+    # Nothing to insert
+    assert crud.bulk_create_db_objects(
+        session=session, db_table=Road, rows=[]) == []
+
+
+def test_bulk_update_db_objects(session):
+    crud.bulk_create_db_objects(
+        session=session, db_table=Location,
+        rows=[{"name": "A1"}, {"name": "B1"}, {"name": "C1"}]
+        )
+    crud.bulk_update_db_objects(
+        session=session, db_table=Location,
+        rows=[{"id": 1, "name": "A2"}, {"id": 3, "name": "C2"}]
+        )
+    # Rows are committed
+    session.rollback()
+    assert [location.name for location in session.exec(
+        select(Location).order_by(Location.id))] == ["A2", "B1", "C2"]
+    # Versioned rows are updated only if version did not change
+    crud.create_db_object(session=session, db_object=Waste(name="Bio"))
+    crud.create_db_object(
+        session=session,
+        db_object=Storage(name="storage1", email="storage1@example.com",
+                          hashed_password="storage1")
+        )
+    crud.create_db_object(
+        session=session,
+        db_object=StorageWasteLink(storage_id=1, waste_id=1, max_amount=10))
+    crud.bulk_update_db_objects(
+        session=session, db_table=StorageWasteLink,
+        rows=[{"storage_id": 1, "waste_id": 1, "amount": 5, "version": 1}]
+        )
+    with pytest.raises(StaleDataError):
+        crud.bulk_update_db_objects(
+            session=session, db_table=StorageWasteLink,
+            rows=[{"storage_id": 1, "waste_id": 1, "amount": 6,
+                   "version": 1}]
+            )
+    session.rollback()
+    assert session.exec(
+        select(StorageWasteLink.amount, StorageWasteLink.version)
+        ).all() == [(5, 2)]
+
+
+def test_create_roads(session, fake_db_session):
+    """
+    Fake db roads (C1 is not in db)
+
+    A1 <-10-- B1 --30-> C1
+       --20->
+     ^
+     40
+     |
+    A2
+    """
+    fake_locations = {}
+    for name in ["A1", "B1", "C1", "A2"]:
+        fake_locations[name] = crud.create_db_object(
+            session=fake_db_session, db_object=Location(name=name))
+    for name_from, name_to, distance in [
+            ("B1", "A1", 10), ("A1", "B1", 20), ("B1", "C1", 30),
+            ("A2", "A1", 40)]:
+        crud.create_db_object(
+            session=fake_db_session,
+            db_object=Road(location_from=fake_locations[name_from],
+                           location_to=fake_locations[name_to],
+                           distance=distance)
+            )
+    db_locations = {}
+    for name in ["A1", "B1", "A2"]:
+        db_locations[name] = crud.create_db_object(
+            session=session, db_object=Location(name=name))
+    create_roads(session=session,
+                 location_in_fake_db=fake_locations["B1"],
+                 db_location=db_locations["B1"])
+    # Road in each direction, no road to missing location
+    assert {(road.location_from.name, road.location_to.name, road.distance)
+            for road in session.exec(select(Road))} == {
+        ("B1", "A1", 10), ("A1", "B1", 20)}
+    create_roads(session=session,
+                 location_in_fake_db=fake_locations["A2"],
+                 db_location=db_locations["A2"])
+    # One way road
+    assert {(road.location_from.name, road.location_to.name, road.distance)
+            for road in session.exec(select(Road))} == {
+        ("B1", "A1", 10), ("A1", "B1", 20), ("A2", "A1", 40)}
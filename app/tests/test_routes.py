@@ -1,13 +1,27 @@
+import time
+from threading import Thread
+
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import update
 from sqlmodel import Session, SQLModel, create_engine
 from sqlmodel.pool import StaticPool
 
 from ..main import app
 from ..config import get_settings
 from ..database import get_session, create_admin, get_fake_db_session
+from ..business_logic.optimal_route import find_optimal_storage_route
+from ..business_logic.road_graph import get_road_graph, bump_graph_version
+from ..business_logic.capacity_index import bump_capacity_version
+from ..business_logic import contraction_hierarchy, distance_table
+from ..business_logic.contraction_hierarchy import get_contraction_hierarchy
+from ..business_logic.transfer_ledger import (
+    record_transfers, create_transfer_snapshot, get_period_totals)
+from ..models.company import Company
 from ..models.location import Location
 from ..models.road import Road
+from ..models.storage import Storage
+from ..models.storagewastelink import StorageWasteLink
 from .routes_test_data import generate_fake_db, generate_companies_and_storages
 
 
@@ -163,6 +177,70 @@ def test_distance_to_storage(fake_db_session, client, admin_auth_header):
     assert response.status_code == 404
 
 
+def test_distance_table_search(
+        fake_db_session, client, admin_auth_header, monkeypatch):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    searches = []
+    find_storage_distances = distance_table.find_storage_distances
+
+    def count_searches(graph, source):
+        searches.append(source)
+        return find_storage_distances(graph=graph, source=source)
+
+    monkeypatch.setattr(
+        distance_table, "find_storage_distances", count_searches)
+    # One search for every storage of the company
+    for storage_id, distance in [(1, 350), (2, 50)]:
+        response = client.get(
+            url=f"api/v1/companies/1/storages/{storage_id}",
+            headers=admin_auth_header
+            )
+        assert response.json()["distance"] == distance
+    assert len(searches) == 1
+
+
+def test_optimal_storage_route(
+        session, fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    # Company id -> {storage id: (storages along the route, distance)}
+    routes = {
+        1: {1: ([2, 1], 350), 2: ([2], 50), 3: ([2, 3], 200),
+            4: ([2, 5, 4], 450), 5: ([2, 5], 300),
+            6: ([2, 5, 8, 9, 6], 600), 7: ([2, 5, 8, 7], 500),
+            8: ([2, 5, 8], 400), 9: ([2, 5, 8, 9], 550),
+            10: None, 11: None},
+        2: {1: ([1], 50), 2: ([1, 2], 350), 3: ([1, 2, 3], 500),
+            4: ([1, 4], 200), 5: ([1, 4, 5], 350),
+            6: ([1, 4, 7, 8, 9, 6], 600), 7: ([1, 4, 7], 300),
+            8: ([1, 4, 7, 8], 400), 9: ([1, 4, 7, 8, 9], 550),
+            10: None, 11: None},
+        3: {3: ([10, 3], 100), 10: ([10], 50), 11: None},
+        4: {9: None, 11: None},
+        }
+    for company_id, storage_routes in routes.items():
+        company = session.get(Company, company_id)
+        for storage_id, expected_route in storage_routes.items():
+            route = find_optimal_storage_route(
+                session=session, company=company,
+                storage=session.get(Storage, storage_id)
+                )
+            if expected_route is None:
+                assert route is None
+                continue
+            storage_ids, distance = expected_route
+            assert [storage.id for storage in route.route_history] \
+                == storage_ids
+            assert route.distance == distance
+
+
 def test_optimal_unload_route(fake_db_session, client, admin_auth_header):
     generate_fake_db(session=fake_db_session)
     generate_companies_and_storages(
@@ -297,3 +375,988 @@ def test_optimal_unload_route(fake_db_session, client, admin_auth_header):
     assert response.json()["route_history"][0]["name"] == "S2"
     assert response.json()["route_history"][1]["name"] == "S5"
     assert response.json()["route_history"][2]["name"] == "S8"
+
+
+def test_connected_storages(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    response = client.get(
+        url="api/v1/companies/1/storages/", headers=admin_auth_header)
+    assert response.status_code == 200
+    names = {storage["name"] for storage in response.json()}
+    assert names == {f"S{i}" for i in range(1, 9 + 1)}
+    response = client.get(
+        url="api/v1/companies/3/storages/", headers=admin_auth_header)
+    assert response.status_code == 200
+    names = {storage["name"] for storage in response.json()}
+    assert names == {f"S{i}" for i in range(1, 10 + 1)}
+    response = client.get(
+        url="api/v1/companies/4/storages/", headers=admin_auth_header)
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_distance_after_network_change(
+        fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    response = client.get(
+        url="api/v1/companies/3/storages/3", headers=admin_auth_header)
+    assert response.json()["distance"] == 100
+    # Delete storage S10, the only way from company C3
+    response = client.delete(
+        url="api/v1/storages/10", headers=admin_auth_header)
+    assert response.status_code == 200
+    response = client.get(
+        url="api/v1/companies/3/storages/3", headers=admin_auth_header)
+    assert response.status_code == 404
+
+
+def test_reachable_storages(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/storages/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 10},
+        headers=admin_auth_header
+        )
+
+    response = client.get(
+        url="api/v1/companies/1/storages/reachable/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 9
+    # Sorted by distance
+    assert [storage["distance"] for storage in data] == [
+        50, 200, 300, 350, 400, 450, 500, 550, 600]
+    assert data[0]["name"] == "S2"
+    assert data[0]["route_length"] == 1
+    assert data[1]["name"] == "S3"
+    assert data[1]["route_length"] == 2
+    assert data[1]["waste_links"][0]["waste_id"] == 1
+    assert data[1]["waste_links"][0]["free_amount"] == 10
+    assert data[8]["name"] == "S6"
+    assert data[8]["route_length"] == 5  # S2, S5, S8, S9, S6
+    response = client.get(
+        url="api/v1/companies/4/storages/reachable/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_unreachable_capacity(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url="api/v1/companies/3/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    # Only isolated storage S11 recieves waste type 1
+    client.post(
+        url="api/v1/storages/11/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    response = client.get(
+        url="api/v1/companies/3/waste-types/1/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 404
+    response = client.get(
+        url="api/v1/companies/3/waste-types/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 404
+    # Storage S3 is reachable
+    client.post(
+        url="api/v1/storages/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    response = client.get(
+        url="api/v1/companies/3/waste-types/1/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    assert response.json()["distance"] == 100
+
+
+def test_route_after_unload(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    for storage_id in [3, 11]:
+        client.post(
+            url=f"api/v1/storages/{storage_id}/waste-types/assign/",
+            json={"waste_id": 1, "max_amount": 10},
+            headers=admin_auth_header
+            )
+    client.patch(
+        url="api/v1/companies/3/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    for _ in range(2):
+        response = client.get(
+            url="api/v1/companies/3/waste-types/1/optimal-route/",
+            headers=admin_auth_header
+            )
+        assert response.status_code == 200
+        assert response.json()["distance"] == 100
+    response = client.post(
+        url="api/v1/companies/3/waste-types/unload/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    client.patch(
+        url="api/v1/companies/3/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    # Storage S3 is full, S11 is unreachable
+    response = client.get(
+        url="api/v1/companies/3/waste-types/1/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 404
+
+
+def test_changes_by_other_process(
+        session, fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.post(
+        url="api/v1/storages/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 10},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url="api/v1/companies/3/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    response = client.get(
+        url="api/v1/companies/3/waste-types/1/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.json()["distance"] == 100
+    # Another process fills the storage, its caches are not shared
+    session.exec(
+        update(StorageWasteLink)
+        .where(StorageWasteLink.storage_id == 3)
+        .values(amount=10, version=StorageWasteLink.version + 1)
+        )
+    session.commit()
+    bump_capacity_version(session=session)
+    response = client.get(
+        url="api/v1/companies/3/waste-types/1/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 404
+    session.exec(
+        update(StorageWasteLink)
+        .where(StorageWasteLink.storage_id == 3)
+        .values(amount=0, version=StorageWasteLink.version + 1)
+        )
+    session.commit()
+    bump_capacity_version(session=session)
+    response = client.get(
+        url="api/v1/companies/3/waste-types/1/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.json()["distance"] == 100
+    # Another process deletes S10, the only way to S3
+    location = session.get(Storage, 10).location_link.location
+    session.delete(location)
+    session.commit()
+    bump_graph_version(session=session)
+    response = client.get(
+        url="api/v1/companies/3/waste-types/1/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 404
+
+
+def test_unload_into_filled_storage(
+        session, fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.post(
+        url="api/v1/storages/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 10},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url="api/v1/companies/3/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    response = client.get(
+        url="api/v1/companies/3/waste-types/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.json()["route_history"][-1]["id"] == 3
+    # Another company fills the storage after the route was found
+    session.exec(
+        update(StorageWasteLink)
+        .where(StorageWasteLink.storage_id == 3)
+        .values(amount=5)
+        )
+    session.commit()
+    response = client.post(
+        url="api/v1/companies/3/waste-types/unload/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 409
+    # Nothing was transferred
+    response = client.get(
+        url="api/v1/companies/3", headers=admin_auth_header)
+    assert response.json()["waste_links"][0]["amount"] == 10
+    response = client.get(
+        url="api/v1/storages/3", headers=admin_auth_header)
+    assert response.json()["waste_links"][0]["amount"] == 5
+
+
+def test_waste_transfer_ledger(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.post(
+        url="api/v1/storages/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 20},
+        headers=admin_auth_header
+        )
+    for amount in [10, 5]:
+        client.patch(
+            url="api/v1/companies/3/waste-types/1/",
+            json={"amount": amount},
+            headers=admin_auth_header
+            )
+        response = client.post(
+            url="api/v1/companies/3/waste-types/1/unload/",
+            headers=admin_auth_header
+            )
+        assert response.status_code == 200
+        if amount == 10:
+            response = client.post(
+                url="api/v1/system/transfers/snapshots/",
+                headers=admin_auth_header
+                )
+            assert response.status_code == 200
+            snapshot = response.json()
+            assert snapshot["last_transfer_id"] == 1
+    response = client.get(
+        url="api/v1/system/transfers/?company_id=3",
+        headers=admin_auth_header
+        )
+    transfers = response.json()
+    assert [transfer["amount"] for transfer in transfers] == [10, 5]
+    assert transfers[0]["storage_id"] == 3
+    assert transfers[0]["distance"] == 100
+    # Totals from snapshot and transfers recorded after it
+    response = client.get(
+        url="api/v1/system/transfers/totals/", headers=admin_auth_header)
+    assert response.json() == [
+        {"company_id": 3, "storage_id": 3, "waste_id": 1, "amount": 15}]
+    response = client.get(
+        url="api/v1/system/transfers/totals/",
+        params={"end": snapshot["created_at"]},
+        headers=admin_auth_header
+        )
+    assert response.json()[0]["amount"] == 10
+    response = client.get(
+        url="api/v1/system/transfers/totals/",
+        params={"start": snapshot["created_at"]},
+        headers=admin_auth_header
+        )
+    assert response.json()[0]["amount"] == 5
+    # Next snapshot includes previous totals
+    client.post(
+        url="api/v1/system/transfers/snapshots/", headers=admin_auth_header)
+    response = client.get(
+        url="api/v1/system/transfers/totals/", headers=admin_auth_header)
+    assert response.json()[0]["amount"] == 15
+
+
+def test_snapshot_waits_for_transfer(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'ledger.db'}",
+        connect_args={"check_same_thread": False}
+        )
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        record_transfers(
+            session=session, company_id=1, transfers={(1, 1): 10},
+            distances={1: 100}
+            )
+        session.commit()
+    snapshots = []
+
+    def create_snapshot():
+        with Session(engine) as session:
+            snapshot = create_transfer_snapshot(session=session)
+            snapshots.append(snapshot.last_transfer_id)
+
+    with Session(engine) as session:
+        # Transfer gets the next id, but commits after the snapshot began
+        record_transfers(
+            session=session, company_id=1, transfers={(1, 1): 5},
+            distances={1: 100}
+            )
+        session.flush()
+        snapshot_thread = Thread(target=create_snapshot)
+        snapshot_thread.start()
+        time.sleep(0.5)
+        session.commit()
+    snapshot_thread.join()
+    assert snapshots == [2]
+    with Session(engine) as session:
+        totals = get_period_totals(session=session)
+    assert [total.amount for total in totals] == [15]
+
+
+def test_unload_plan(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    for company_id, amount in [(1, 5), (3, 10)]:
+        client.post(
+            url=f"api/v1/companies/{company_id}/waste-types/assign/",
+            json={"waste_id": 1, "max_amount": 100},
+            headers=admin_auth_header
+            )
+        client.patch(
+            url=f"api/v1/companies/{company_id}/waste-types/1/",
+            json={"amount": amount},
+            headers=admin_auth_header
+            )
+    for storage_id in [3, 11]:
+        client.post(
+            url=f"api/v1/storages/{storage_id}/waste-types/assign/",
+            json={"waste_id": 1, "max_amount": 10},
+            headers=admin_auth_header
+            )
+    response = client.get(
+        url="api/v1/system/unload-plan/", headers=admin_auth_header)
+    assert response.status_code == 200
+    data = response.json()
+    plans = {plan["company_id"]: plan for plan in data["plans"]}
+    assert list(plans) == [1, 2, 3, 4]
+    assert plans[1]["route"]["distance"] == 200
+    assert [storage["name"] for storage in
+            plans[1]["route"]["route_history"]] == ["S2", "S3"]
+    assert plans[3]["route"]["distance"] == 100
+    # Nothing to unload
+    assert plans[2]["route"] is None
+    assert plans[2]["expansions"] == 0
+    assert data["expansions"] == sum(
+        plan["expansions"] for plan in data["plans"])
+    assert data["expansions"] > 0
+    # C1 takes free space of S3 first
+    response = client.get(
+        url="api/v1/system/unload-plan/",
+        params={"company_ids": [1, 3], "reserve_capacity": True},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    plans = {plan["company_id"]: plan for plan in response.json()["plans"]}
+    assert list(plans) == [1, 3]
+    assert plans[1]["route"]["distance"] == 200
+    assert plans[3]["route"] is None
+
+
+def test_optimal_allocation(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/1/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url="api/v1/companies/1/waste-types/1/",
+        json={"amount": 15},
+        headers=admin_auth_header
+        )
+    for storage_id, max_amount in [(1, 10), (2, 5), (3, 5)]:
+        client.post(
+            url=f"api/v1/storages/{storage_id}/waste-types/assign/",
+            json={"waste_id": 1, "max_amount": max_amount},
+            headers=admin_auth_header
+            )
+    # Single route fills S2 and S1 (5 * 50 + 10 * 350)
+    response = client.get(
+        url="api/v1/companies/1/waste-types/1/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    assert [storage["name"] for storage in
+            response.json()["route_history"]] == ["S2", "S1"]
+    # Nearest storages are filled first
+    response = client.get(
+        url="api/v1/companies/1/waste-types/1/optimal-allocation/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    data = response.json()
+    assert [(allocation["storage"]["name"], allocation["amount"],
+             allocation["distance"])
+            for allocation in data["allocations"]] == [
+        ("S2", 5, 50), ("S3", 5, 200), ("S1", 5, 350)]
+    assert data["cost"] == 3000
+
+    response = client.post(
+        url="api/v1/companies/1/waste-types/1/unload/",
+        params={"solver": True},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    for storage_id, amount in [(1, 5), (2, 5), (3, 5)]:
+        response = client.get(
+            url=f"api/v1/storages/{storage_id}", headers=admin_auth_header)
+        assert response.json()["waste_links"][0]["amount"] == amount
+    response = client.get(
+        url="api/v1/companies/1", headers=admin_auth_header)
+    assert response.json()["waste_links"][0]["amount"] == 0
+    # Only 5 units of free space left
+    client.patch(
+        url="api/v1/companies/1/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    response = client.get(
+        url="api/v1/companies/1/waste-types/1/optimal-allocation/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 404
+
+
+def test_multi_waste_partial_unload(
+        fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    for name in ["Bio", "Glass"]:
+        client.post(
+            "api/v1/wastes/create/", headers=admin_auth_header,
+            json={"name": name}
+            )
+    for waste_id in [1, 2]:
+        client.post(
+            url="api/v1/companies/1/waste-types/assign/",
+            json={"waste_id": waste_id, "max_amount": 100},
+            headers=admin_auth_header
+            )
+        client.patch(
+            url=f"api/v1/companies/1/waste-types/{waste_id}/",
+            json={"amount": 10},
+            headers=admin_auth_header
+            )
+    for storage_id, waste_id in [(1, 1), (1, 2), (2, 1), (3, 2)]:
+        client.post(
+            url=f"api/v1/storages/{storage_id}/waste-types/assign/",
+            json={"waste_id": waste_id, "max_amount": 10},
+            headers=admin_auth_header
+            )
+    # Only S1 recieves both waste types
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    assert response.json()["distance"] == 350
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-route/",
+        params={"partial_unload": True},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["distance"] == 200
+    assert [storage["name"] for storage in
+            data["route_history"]] == ["S2", "S3"]
+
+    response = client.post(
+        url="api/v1/companies/1/waste-types/unload/",
+        params={"partial_unload": True},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    for storage_id, amounts in [(1, [0, 0]), (2, [10]), (3, [10])]:
+        response = client.get(
+            url=f"api/v1/storages/{storage_id}", headers=admin_auth_header)
+        assert [waste_link["amount"] for waste_link in
+                response.json()["waste_links"]] == amounts
+    response = client.get(
+        url="api/v1/companies/1", headers=admin_auth_header)
+    assert [waste_link["amount"] for waste_link in
+            response.json()["waste_links"]] == [0, 0]
+
+
+def test_multi_waste_sparse_capacity(
+        fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    for name in ["Bio", "Glass"]:
+        client.post(
+            "api/v1/wastes/create/", headers=admin_auth_header,
+            json={"name": name}
+            )
+    for waste_id in [1, 2]:
+        client.post(
+            url="api/v1/companies/1/waste-types/assign/",
+            json={"waste_id": waste_id, "max_amount": 100},
+            headers=admin_auth_header
+            )
+        client.patch(
+            url=f"api/v1/companies/1/waste-types/{waste_id}/",
+            json={"amount": 10},
+            headers=admin_auth_header
+            )
+    # Every waste type has one storage
+    for storage_id, waste_id in [(3, 1), (1, 2)]:
+        client.post(
+            url=f"api/v1/storages/{storage_id}/waste-types/assign/",
+            json={"waste_id": waste_id, "max_amount": 10},
+            headers=admin_auth_header
+            )
+    # Route is completed by going to the nearest storages
+    settings = get_settings().model_copy(
+        update={"route_max_expansions": 1})
+    app.dependency_overrides[get_settings] = lambda: settings
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-route/",
+        params={"partial_unload": True},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["distance"] == 650
+    assert data["approximate"]
+    del app.dependency_overrides[get_settings]
+    # Route returns from S3 through S2
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-route/",
+        params={"partial_unload": True},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["distance"] == 650
+    assert [storage["name"] for storage in
+            data["route_history"]] == ["S2", "S3", "S2", "S1"]
+    assert not data["approximate"]
+
+    response = client.post(
+        url="api/v1/companies/1/waste-types/unload/",
+        params={"partial_unload": True},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    for storage_id, amount in [(1, 10), (3, 10)]:
+        response = client.get(
+            url=f"api/v1/storages/{storage_id}", headers=admin_auth_header)
+        assert response.json()["waste_links"][0]["amount"] == amount
+    response = client.get(
+        url="api/v1/companies/1", headers=admin_auth_header)
+    assert [waste_link["amount"] for waste_link in
+            response.json()["waste_links"]] == [0, 0]
+    # Not enough space is left
+    client.patch(
+        url="api/v1/companies/1/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-route/",
+        params={"partial_unload": True},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 404
+
+
+def test_alternative_routes(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/1/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url="api/v1/companies/1/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    for storage_id, max_amount in [(1, 10), (2, 10), (3, 20), (5, 5)]:
+        client.post(
+            url=f"api/v1/storages/{storage_id}/waste-types/assign/",
+            json={"waste_id": 1, "max_amount": max_amount},
+            headers=admin_auth_header
+            )
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-routes/",
+        params={"k": 4},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    routes = response.json()
+    # S5 has not enough space, but routes can pass through it
+    assert [(route["distance"],
+             [storage["name"] for storage in route["route_history"]])
+            for route in routes] == [
+        (50, ["S2"]), (200, ["S2", "S3"]), (350, ["S2", "S1"]),
+        (600, ["S2", "S5", "S4", "S1"])
+        ]
+    assert routes[1]["coverage"] == [
+        {"waste_id": 1, "amount": 10, "free_amount": 20}]
+
+
+def test_contraction_hierarchy_distance(
+        session, fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    settings = get_settings().model_copy(
+        update={"contraction_hierarchy": True})
+    app.dependency_overrides[get_settings] = lambda: settings
+    distances = {1: 350, 2: 50, 3: 200, 4: 450, 5: 300, 6: 600, 7: 500,
+                 8: 400, 9: 550, 10: None, 11: None}
+    # Distances are found without hierarchy, until it is built
+    for _ in range(2):
+        for storage_id, distance in distances.items():
+            response = client.get(
+                url=f"api/v1/companies/1/storages/{storage_id}",
+                headers=admin_auth_header
+                )
+            if distance is None:
+                assert response.status_code == 404
+            else:
+                assert response.json()["distance"] == distance
+        graph = get_road_graph(session=session)
+        assert get_contraction_hierarchy(graph=graph, wait=True)
+
+
+def test_contraction_hierarchy_build_failure(
+        session, fake_db_session, client, admin_auth_header, monkeypatch,
+        caplog):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    def build_contraction_hierarchy(graph):
+        raise MemoryError
+
+    graph = get_road_graph(session=session)
+    with monkeypatch.context() as patch:
+        patch.setattr(
+            contraction_hierarchy, "build_contraction_hierarchy",
+            build_contraction_hierarchy
+            )
+        assert get_contraction_hierarchy(graph=graph, wait=True) is None
+    assert "Contraction hierarchy build failed" in caplog.text
+    # Build is started again
+    assert get_contraction_hierarchy(graph=graph, wait=True)
+
+
+def test_contraction_hierarchy_outdated_build(
+        session, fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    graph = get_road_graph(session=session)
+    bump_graph_version(session=session)
+    new_graph = get_road_graph(session=session)
+    assert new_graph is not graph
+    # Build for the outdated snapshot is stopped
+    assert get_contraction_hierarchy(graph=graph, wait=True) is None
+    assert get_contraction_hierarchy(graph=new_graph, wait=True)
+    assert contraction_hierarchy.current_build[0] is new_graph
+
+
+def test_reaching_companies(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url="api/v1/companies/3/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    response = client.get(
+        url="api/v1/storages/3/companies/", headers=admin_auth_header)
+    assert response.status_code == 200
+    data = response.json()
+    assert [(company["name"], company["distance"])
+            for company in data] == [("C3", 100), ("C1", 200), ("C2", 500)]
+    assert data[0]["waste_links"] == [
+        {"waste_id": 1, "max_amount": 100, "amount": 10}]
+    # Isolated storage
+    response = client.get(
+        url="api/v1/storages/11/companies/", headers=admin_auth_header)
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_nearest_storages(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    for storage_id, max_amount in [(1, 20), (2, 5), (3, 20), (9, 20),
+                                   (11, 100)]:
+        client.post(
+            url=f"api/v1/storages/{storage_id}/waste-types/assign/",
+            json={"waste_id": 1, "max_amount": max_amount},
+            headers=admin_auth_header
+            )
+    response = client.get(
+        url="api/v1/companies/1/waste-types/1/nearest-storages/",
+        params={"k": 2, "min_free_amount": 10},
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    assert [(storage["name"], storage["distance"])
+            for storage in response.json()] == [("S3", 200), ("S1", 350)]
+    # Unreachable S11 is not listed
+    response = client.get(
+        url="api/v1/companies/1/waste-types/1/nearest-storages/",
+        params={"min_free_amount": 10},
+        headers=admin_auth_header
+        )
+    assert [storage["name"] for storage in response.json()] == [
+        "S3", "S1", "S9"]
+    response = client.get(
+        url="api/v1/companies/1/waste-types/1/nearest-storages/",
+        params={"k": 1},
+        headers=admin_auth_header
+        )
+    data = response.json()
+    assert [storage["name"] for storage in data] == ["S2"]
+    assert data[0]["waste_links"][0]["free_amount"] == 5
+    response = client.get(
+        url="api/v1/companies/1/waste-types/2/nearest-storages/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 404
+
+
+def test_route_search_limits(fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/1/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url="api/v1/companies/1/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    client.post(
+        url="api/v1/storages/1/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 10},
+        headers=admin_auth_header
+        )
+    # No complete route is found after expanding S2
+    settings = get_settings().model_copy(
+        update={"route_max_expansions": 1})
+    app.dependency_overrides[get_settings] = lambda: settings
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 503
+    # Route to S1 is found, but not proven to be optimal
+    settings = get_settings().model_copy(
+        update={"route_max_expansions": 2})
+    app.dependency_overrides[get_settings] = lambda: settings
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-route/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["distance"] == 350
+    assert data["approximate"]
+    assert data["stats"]["expansions"] == 2
+    assert data["stats"]["open_set_peak"] == 3
+
+    del app.dependency_overrides[get_settings]
+    response = client.get(
+        url="api/v1/companies/1/waste-types/optimal-route/",
+        headers=admin_auth_header
+        )
+    data = response.json()
+    assert data["distance"] == 350
+    assert not data["approximate"]
+    assert data["stats"]["expansions"] == 4
+
+
+def test_partial_unload_through_storage(
+        fake_db_session, client, admin_auth_header):
+    generate_fake_db(session=fake_db_session)
+    generate_companies_and_storages(
+        client=client, admin_auth_header=admin_auth_header)
+    # Look for test data in routes_test_data.py
+
+    client.post(
+        "api/v1/wastes/create/", headers=admin_auth_header,
+        json={"name": "Bio"}
+        )
+    client.post(
+        url="api/v1/companies/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 100},
+        headers=admin_auth_header
+        )
+    client.patch(
+        url="api/v1/companies/3/waste-types/1/",
+        json={"amount": 10},
+        headers=admin_auth_header
+        )
+    client.post(
+        url="api/v1/storages/3/waste-types/assign/",
+        json={"waste_id": 1, "max_amount": 10},
+        headers=admin_auth_header
+        )
+    # Route passes S10, that does not recieve waste type 1
+    response = client.post(
+        url="api/v1/companies/3/waste-types/1/unload/",
+        headers=admin_auth_header
+        )
+    assert response.status_code == 200
+    response = client.get(
+        url="api/v1/storages/3", headers=admin_auth_header)
+    assert response.json()["waste_links"][0]["amount"] == 10
+    response = client.get(
+        url="api/v1/companies/3", headers=admin_auth_header)
+    assert response.json()["waste_links"][0]["amount"] == 0
@@ -1,11 +1,12 @@
 # import os
 import os
 import string
-from random import randint
 
 from sqlmodel import (
     Session, Field, Relationship, SQLModel, create_engine, select)
 
+from layouts import generate_grid_layout, generate_random_graph_layout
+
 
 class Location(SQLModel, table=True):
     # DB columns
@@ -52,10 +53,12 @@ def get_db_object_by_field(
     return db_object
 
 
-def generate_random_fake_db(session: Session):
+def generate_random_fake_db(
+        session: Session, rows: int = 5, columns: int = 5,
+        seed: int | None = None):
 
     """
-    Location layout
+    Location layout (rows x columns grid with random distances)
 
     A1--B1--C1--D1--E1
     |   |   |   |   |
@@ -68,42 +71,35 @@ def generate_random_fake_db(session: Session):
     A5--B5--C5--D5--E5
     """
 
-    def create_one_way_road(
-            session: Session, location_from: Location, location_to: Location):
-        road = Road(location_from=location_from, location_to=location_to,
-                    distance=randint(1, 300)
-                    )
-        create_db_object(session=session, db_object=road)
-
-    def create_two_way_road(
-            session: Session, location_from: Location, location_to: Location):
-        distance = randint(1, 300)
-        road_1 = Road(location_from=location_from, location_to=location_to,
-                      distance=distance
-                      )
-        create_db_object(session=session, db_object=road_1)
-        road_2 = Road(location_from=location_to, location_to=location_from,
-                      distance=distance
-                      )
-        create_db_object(session=session, db_object=road_2)
-
-    locations = []
-    for i in range(5):
-        locations.append([])
-        for j in range(5):
-            location = Location(name=f"{string.ascii_uppercase[j]}{i+1}")
-            create_db_object(session=session, db_object=location)
-            locations[i].append(location)
-            if j > 0:
-                create_two_way_road(session=session,
-                                    location_from=locations[i][j-1],
-                                    location_to=locations[i][j]
-                                    )
-            if i > 0:
-                create_two_way_road(session=session,
-                                    location_from=locations[i-1][j],
-                                    location_to=locations[i][j]
-                                    )
+    names, roads = generate_grid_layout(rows=rows, columns=columns, seed=seed)
+    create_layout(session=session, names=names, roads=roads)
+
+
+def generate_random_graph_fake_db(
+        session: Session, location_count: int, roads_per_location: int = 2,
+        seed: int | None = None):
+    """ Random graph layout, see generate_random_graph_layout() """
+    names, roads = generate_random_graph_layout(
+        location_count=location_count,
+        roads_per_location=roads_per_location, seed=seed
+        )
+    create_layout(session=session, names=names, roads=roads)
+
+
+def create_layout(
+        session: Session, names: list[str],
+        roads: list[tuple[int, int, int]]):
+    """ Create locations and roads with one commit (layouts can be large) """
+    locations = [Location(name=name) for name in names]
+    session.add_all(locations)
+    session.flush()
+    session.add_all([
+        Road(location_from_id=locations[index_from].id,
+             location_to_id=locations[index_to].id,
+             distance=distance)
+        for index_from, index_to, distance in roads
+        ])
+    session.commit()
 
 
 def generate_fake_db(session: Session):
@@ -0,0 +1,72 @@
+import string
+from random import Random
+
+
+def location_name(row: int, column: int) -> str:
+    """ Grid location name: column letters and row number (A1, B1, ...,
+    Z1, AA1, ...)
+    """
+    letters = ""
+    column += 1
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = string.ascii_uppercase[remainder] + letters
+    return f"{letters}{row + 1}"
+
+
+def generate_grid_layout(
+        rows: int, columns: int, max_distance: int = 300,
+        seed: int | None = None
+        ) -> tuple[list[str], list[tuple[int, int, int]]]:
+    """
+    Location names and two-way roads (index from, index to, distance) of
+    a grid with random distances
+
+    A1--B1--C1
+    |   |   |
+    A2--B2--C2
+    """
+    random = Random(seed)
+    names = []
+    roads = []
+    for i in range(rows):
+        for j in range(columns):
+            index = len(names)
+            names.append(location_name(row=i, column=j))
+            if j > 0:
+                distance = random.randint(1, max_distance)
+                roads.append((index - 1, index, distance))
+                roads.append((index, index - 1, distance))
+            if i > 0:
+                distance = random.randint(1, max_distance)
+                roads.append((index - columns, index, distance))
+                roads.append((index, index - columns, distance))
+    return names, roads
+
+
+def generate_random_graph_layout(
+        location_count: int, roads_per_location: int = 2,
+        one_way_share: float = 0.1, max_distance: int = 300,
+        seed: int | None = None
+        ) -> tuple[list[str], list[tuple[int, int, int]]]:
+    """ Location names and roads (index from, index to, distance) of a
+    random graph. Every location is connected to "roads_per_location"
+    random locations, part of roads are one-way
+    """
+    random = Random(seed)
+    names = [f"L{i + 1}" for i in range(location_count)]
+    connected = set()
+    roads = []
+    for index in range(location_count):
+        for _ in range(roads_per_location):
+            other = random.randrange(location_count)
+            if other == index or (index, other) in connected:
+                continue
+            distance = random.randint(1, max_distance)
+            connected.add((index, other))
+            roads.append((index, other, distance))
+            if random.random() >= one_way_share \
+                    and (other, index) not in connected:
+                connected.add((other, index))
+                roads.append((other, index, distance))
+    return names, roads
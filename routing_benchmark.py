@@ -0,0 +1,297 @@
+"""
+Routing benchmark on synthetic road networks
+
+Generates grid or random graph layouts (see fake_db_app/layouts.py) in an
+in-memory SQLite database and times route searches. Results are printed
+as JSON, so that engine changes can be compared.
+
+Run from the project root:
+    python routing_benchmark.py --layout grid --sizes 100 1000 10000
+
+Multi waste search with sparse storage capacity:
+    python routing_benchmark.py --sizes 3600 --waste-types 10 \
+        --waste-link-share 0.05 --time-limit-ms 5000
+"""
+import argparse
+import json
+import math
+import statistics
+import time
+from random import Random
+
+from sqlalchemy import insert
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+from fake_db_app.layouts import (
+    generate_grid_layout, generate_random_graph_layout)
+from app.models.company import Company
+from app.models.companylocationlink import CompanyLocationLink
+from app.models.companywastelink import CompanyWasteLink
+from app.models.location import Location
+from app.models.road import Road
+from app.models.storage import Storage
+from app.models.storagelocationlink import StorageLocationLink
+from app.models.storagewastelink import StorageWasteLink
+from app.models.waste import Waste
+from app.business_logic.optimal_route import (
+    SearchBudget, SearchLimitExceeded, find_optimal_storage_route,
+    find_optimal_unload_route, find_connected_storages
+    )
+from app.business_logic.multi_waste_route import (
+    find_multi_waste_unload_route)
+from app.business_logic.road_graph import bump_graph_version
+from app.business_logic.cache_version import create_cache_version
+
+
+def create_network(
+        session: Session, names: list[str],
+        roads: list[tuple[int, int, int]], random: Random,
+        company_share: float, storage_density: float, waste_types: int,
+        waste_link_share: float
+        ):
+    """ Assign random locations to companies and storages. As in the app
+    database, only occupied locations and roads between them are stored
+    """
+    companies = []
+    storages = []
+    for index in range(len(names)):
+        share = random.random()
+        if share < company_share:
+            companies.append(index)
+        elif share < company_share + storage_density:
+            storages.append(index)
+    if not companies:
+        companies.append(storages.pop())
+    occupied = {index: index + 1 for index in companies + storages}
+
+    session.execute(insert(Location), [
+        {"id": location_id, "name": names[index]}
+        for index, location_id in occupied.items()
+        ])
+    session.execute(insert(Road), [
+        {"location_from_id": occupied[index_from],
+         "location_to_id": occupied[index_to], "distance": distance}
+        for index_from, index_to, distance in roads
+        if index_from in occupied and index_to in occupied
+        ])
+    session.execute(insert(Waste), [
+        {"id": i + 1, "name": f"waste{i + 1}"} for i in range(waste_types)])
+    session.execute(insert(Company), [
+        {"id": i + 1, "name": f"company{i + 1}",
+         "email": f"company{i + 1}@example.com",
+         "hashed_password": "benchmark"}
+        for i in range(len(companies))
+        ])
+    session.execute(insert(Storage), [
+        {"id": i + 1, "name": f"storage{i + 1}",
+         "email": f"storage{i + 1}@example.com",
+         "hashed_password": "benchmark"}
+        for i in range(len(storages))
+        ])
+    session.execute(insert(CompanyLocationLink), [
+        {"company_id": i + 1, "location_id": occupied[index]}
+        for i, index in enumerate(companies)
+        ])
+    session.execute(insert(StorageLocationLink), [
+        {"storage_id": i + 1, "location_id": occupied[index]}
+        for i, index in enumerate(storages)
+        ])
+    session.execute(insert(CompanyWasteLink), [
+        {"company_id": i + 1, "waste_id": waste_id, "max_amount": 100,
+         "amount": random.randint(1, 100)}
+        for i in range(len(companies))
+        for waste_id in range(1, waste_types + 1)
+        ])
+    storage_waste_links = [
+        {"storage_id": i + 1, "waste_id": waste_id,
+         "max_amount": random.randint(1, 100), "amount": 0}
+        for i in range(len(storages))
+        for waste_id in range(1, waste_types + 1)
+        if random.random() < waste_link_share
+        ]
+    if storage_waste_links:
+        session.execute(insert(StorageWasteLink), storage_waste_links)
+    session.commit()
+    return len(occupied), len(companies), len(storages)
+
+
+def time_calls(function, calls: list[dict], cold: bool) -> dict:
+    """ Call function with every set of arguments, collect timings """
+    timings = []
+    found = 0
+    approximate = 0
+    limit_exceeded = 0
+    for kwargs in calls:
+        if cold:
+            bump_graph_version(session=kwargs["session"])
+        start = time.perf_counter()
+        try:
+            result = function(**kwargs)
+        except SearchLimitExceeded:
+            result = None
+            limit_exceeded += 1
+        timings.append(time.perf_counter() - start)
+        if result:
+            found += 1
+            if getattr(result, "approximate", False):
+                approximate += 1
+    return {
+        "calls": len(timings),
+        "found": found,
+        "approximate": approximate,
+        "limit_exceeded": limit_exceeded,
+        "mean_ms": statistics.mean(timings) * 1000,
+        "median_ms": statistics.median(timings) * 1000,
+        "max_ms": max(timings) * 1000,
+        }
+
+
+def run_benchmark(
+        layout: str, size: int, queries: int, seed: int, cold: bool,
+        company_share: float, storage_density: float, waste_types: int,
+        waste_link_share: float, time_limit_ms: float | None = None
+        ) -> dict:
+    random = Random(seed)
+    budget = SearchBudget(time_limit_ms=time_limit_ms)
+    if layout == "grid":
+        side = math.ceil(math.sqrt(size))
+        names, roads = generate_grid_layout(rows=side, columns=side, seed=seed)
+    else:
+        names, roads = generate_random_graph_layout(
+            location_count=size, seed=seed)
+
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+        )
+    SQLModel.metadata.create_all(engine)
+    # Versions of a new database differ from versions of the previous one,
+    # so its snapshot and routes are not reused
+    create_cache_version(engine)
+    with Session(engine) as session:
+        locations, company_count, storage_count = create_network(
+            session=session, names=names, roads=roads, random=random,
+            company_share=company_share, storage_density=storage_density,
+            waste_types=waste_types, waste_link_share=waste_link_share
+            )
+        companies = [
+            session.get(Company, random.randint(1, company_count))
+            for _ in range(queries)
+            ]
+        storages = [
+            session.get(Storage, random.randint(1, storage_count))
+            for _ in range(queries)
+            ]
+        for company in companies:
+            # Load waste links before timing
+            company.waste_links
+        functions = {
+            "find_optimal_storage_route": time_calls(
+                function=find_optimal_storage_route, cold=cold,
+                calls=[
+                    {"session": session, "company": company,
+                     "storage": storage}
+                    for company, storage in zip(companies, storages)
+                    ]
+                ),
+            "find_optimal_unload_route": time_calls(
+                function=find_optimal_unload_route, cold=cold,
+                calls=[
+                    {"session": session, "company": company,
+                     "company_waste_links": company.waste_links,
+                     "partial_unload": False, "budget": budget}
+                    for company in companies
+                    ]
+                ),
+            "find_optimal_unload_route_partial": time_calls(
+                function=find_optimal_unload_route, cold=cold,
+                calls=[
+                    {"session": session, "company": company,
+                     "company_waste_links": [
+                         random.choice(company.waste_links)],
+                     "partial_unload": True, "budget": budget}
+                    for company in companies
+                    ]
+                ),
+            "find_multi_waste_unload_route": time_calls(
+                function=find_multi_waste_unload_route, cold=cold,
+                calls=[
+                    {"session": session, "company": company,
+                     "company_waste_links": company.waste_links,
+                     "budget": budget}
+                    for company in companies
+                    ]
+                ),
+            "find_connected_storages": time_calls(
+                function=find_connected_storages, cold=cold,
+                calls=[
+                    {"session": session, "company": company}
+                    for company in companies
+                    ]
+                ),
+            }
+        road_count = len(session.exec(select(Road.distance)).all())
+    return {
+        "layout_locations": len(names),
+        "locations": locations,
+        "roads": road_count,
+        "companies": company_count,
+        "storages": storage_count,
+        "functions": functions,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--layout", choices=["grid", "random"], default="grid")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+        help="number of locations in layout (10^2 to 10^5)")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--cold", action="store_true",
+        help="reload road graph snapshot before every call")
+    parser.add_argument(
+        "--company-share", type=float, default=0.01,
+        help="share of locations occupied by companies")
+    parser.add_argument(
+        "--storage-density", type=float, default=0.6,
+        help="share of locations occupied by storages")
+    parser.add_argument("--waste-types", type=int, default=3)
+    parser.add_argument(
+        "--waste-link-share", type=float, default=0.3,
+        help="probability, that storage recieves a waste type")
+    parser.add_argument(
+        "--time-limit-ms", type=float,
+        help="search budget of unload route searches (no limit by default)")
+    parser.add_argument("--output", help="write JSON to file")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results.append(run_benchmark(
+            layout=args.layout, size=size, queries=args.queries,
+            seed=args.seed, cold=args.cold,
+            company_share=args.company_share,
+            storage_density=args.storage_density,
+            waste_types=args.waste_types,
+            waste_link_share=args.waste_link_share,
+            time_limit_ms=args.time_limit_ms
+            ))
+    report = json.dumps(
+        {"layout": args.layout, "seed": args.seed, "cold": args.cold,
+         "results": results},
+        indent=2
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
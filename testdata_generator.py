@@ -236,3 +236,11 @@ with conn.cursor() as cur:
             cur=cur, storage=f"storage{i}", location=f"S{i}_location"
             )
     conn.commit()
+
+    # Running application reloads cached road network and routes
+    cur.execute(
+        "UPDATE cacheversion SET \
+        graph_version = graph_version + 1, \
+        capacity_version = capacity_version + 1;"
+        )
+    conn.commit()